@@ -24,6 +24,7 @@ setup(name='steppy',
       license='MIT',
       install_requires=[
           'ipython>=6.4.0',
+          'joblib>=0.14.0',
           'numpy>=1.14.0',
           'pydot_ng>=1.0.0',
           'pytest>=3.6.0',
@@ -1,4 +1,4 @@
-from typing import Tuple, List, Dict, Any, NamedTuple
+from typing import Tuple, List, Dict, Any, NamedTuple, Callable
 
 E = NamedTuple('E', [('input_name', str),
                      ('key', str)]
@@ -7,6 +7,7 @@ E = NamedTuple('E', [('input_name', str),
 AdaptingRecipe = Any
 DataPacket = Dict[str, Any]
 AllOutputs = Dict[str, DataPacket]
+CompiledRecipe = Callable[[AllOutputs], Any]
 
 
 class AdapterError(Exception):
@@ -100,9 +101,40 @@ class Adapter:
 
                 5. Anything else: the value itself will be used as the argument
                     to the transformer
+
+                Recipes are compiled once, when they are assigned. Assign new recipes
+                instead of modifying `adapting_recipes` in place.
+
+        Raises:
+            AdapterError: if `adapting_recipes` is not a dict with str keys, or if
+                an extractor `E` names its input with an unhashable name.
         """
         self.adapting_recipes = adapting_recipes
 
+    @property
+    def adapting_recipes(self) -> Dict[str, AdaptingRecipe]:
+        return self._adapting_recipes
+
+    @adapting_recipes.setter
+    def adapting_recipes(self, adapting_recipes: Dict[str, AdaptingRecipe]):
+        if not isinstance(adapting_recipes, dict):
+            msg = "Adapting recipes must be dict, got {} instead.".format(type(adapting_recipes))
+            raise AdapterError(msg)
+        for name in adapting_recipes:
+            if not isinstance(name, str):
+                msg = "Adapting recipe names must be str, got {!r} instead.".format(name)
+                raise AdapterError(msg)
+        self._adapting_recipes = adapting_recipes
+        # top-level extractors are grouped by input, so that each input is looked up once
+        self._extracted_keys = {}
+        self._compiled_recipes = {}
+        for name, recipe in adapting_recipes.items():
+            if recipe.__class__ is E:
+                _validate_element(recipe)
+                self._extracted_keys.setdefault(recipe.input_name, []).append((name, recipe.key))
+            else:
+                self._compiled_recipes[name] = self._compile(recipe)
+
     def adapt(self, all_ouputs: AllOutputs) -> DataPacket:
         """Adapt inputs for the transformer included in the step.
 
@@ -116,42 +148,73 @@ class Adapter:
             constructed according to the respective recipes.
 
         """
-        adapted = {}
-        for name, recipe in self.adapting_recipes.items():
-            adapted[name] = self._construct(all_ouputs, recipe)
+        # keys are set in the order of recipes, even though top-level elements are extracted first
+        adapted = dict.fromkeys(self.adapting_recipes)
+        for input_name, names_keys in self._extracted_keys.items():
+            input_results = _get_input_results(all_ouputs, input_name)
+            for name, key in names_keys:
+                adapted[name] = _get_result(input_results, input_name, key)
+        for name, construct in self._compiled_recipes.items():
+            adapted[name] = construct(all_ouputs)
         return adapted
 
-    def _construct(self, all_ouputs: AllOutputs, recipe: AdaptingRecipe) -> Any:
-        return {
-            E: self._construct_element,
-            tuple: self._construct_tuple,
-            list: self._construct_list,
-            dict: self._construct_dict,
-        }.get(recipe.__class__, self._construct_constant)(all_ouputs, recipe)
+    def _compile(self, recipe: AdaptingRecipe) -> CompiledRecipe:
+        compile_recipe = getattr(self, self._recipe_compilers.get(recipe.__class__, '_compile_constant'))
+        return compile_recipe(recipe)
 
-    def _construct_constant(self, _: AllOutputs, constant) -> Any:
-        return constant
+    def _compile_constant(self, constant) -> CompiledRecipe:
+        return lambda _: constant
 
-    def _construct_element(self, all_ouputs: AllOutputs, element: E):
+    def _compile_element(self, element: E) -> CompiledRecipe:
+        _validate_element(element)
         input_name = element.input_name
         key = element.key
-        try:
-            input_results = all_ouputs[input_name]
-            try:
-                return input_results[key]
-            except KeyError:
-                msg = "Input '{}' didn't have '{}' in its result.".format(input_name, key)
-                raise AdapterError(msg)
-        except KeyError:
-            msg = "No such input: '{}'".format(input_name)
-            raise AdapterError(msg)
-
-    def _construct_list(self, all_ouputs: AllOutputs, lst: List[AdaptingRecipe]):
-        return [self._construct(all_ouputs, recipe) for recipe in lst]
-
-    def _construct_tuple(self, all_ouputs: AllOutputs, tup: Tuple):
-        return tuple(self._construct(all_ouputs, recipe) for recipe in tup)
 
-    def _construct_dict(self, all_ouputs: AllOutputs, dic: Dict[AdaptingRecipe, AdaptingRecipe]):
-        return {self._construct(all_ouputs, k): self._construct(all_ouputs, v)
-                for k, v in dic.items()}
+        def construct_element(all_ouputs: AllOutputs):
+            return _get_result(_get_input_results(all_ouputs, input_name), input_name, key)
+        return construct_element
+
+    def _compile_list(self, lst: List[AdaptingRecipe]) -> CompiledRecipe:
+        constructs = [self._compile(recipe) for recipe in lst]
+        return lambda all_ouputs: [construct(all_ouputs) for construct in constructs]
+
+    def _compile_tuple(self, tup: Tuple) -> CompiledRecipe:
+        constructs = [self._compile(recipe) for recipe in tup]
+        return lambda all_ouputs: tuple(construct(all_ouputs) for construct in constructs)
+
+    def _compile_dict(self, dic: Dict[AdaptingRecipe, AdaptingRecipe]) -> CompiledRecipe:
+        constructs = [(self._compile(k), self._compile(v)) for k, v in dic.items()]
+        return lambda all_ouputs: {construct_key(all_ouputs): construct_value(all_ouputs)
+                                   for construct_key, construct_value in constructs}
+
+    # method names, so that subclasses can override the compilers
+    _recipe_compilers = {
+        E: '_compile_element',
+        tuple: '_compile_tuple',
+        list: '_compile_list',
+        dict: '_compile_dict',
+    }
+
+
+def _validate_element(element: E):
+    try:
+        hash(element.input_name)
+    except TypeError as e:
+        msg = "Input name of {} must be hashable, got {} instead.".format(element, type(element.input_name))
+        raise AdapterError(msg) from e
+
+
+def _get_input_results(all_ouputs: AllOutputs, input_name: str) -> DataPacket:
+    try:
+        return all_ouputs[input_name]
+    except KeyError:
+        msg = "No such input: '{}'".format(input_name)
+        raise AdapterError(msg)
+
+
+def _get_result(input_results: DataPacket, input_name: str, key: str) -> Any:
+    try:
+        return input_results[key]
+    except KeyError:
+        msg = "Input '{}' didn't have '{}' in its result.".format(input_name, key)
+        raise AdapterError(msg)
@@ -1,15 +1,53 @@
+import copy
+import functools
 import os
+import pickle
 import pprint
-from collections import defaultdict
+import shutil
+import threading
+import weakref
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from sklearn.externals import joblib
+import joblib
+import numpy as np
 
 from steppy.adapter import Adapter, AdapterError
-from steppy.utils import display_upstream_structure, persist_as_png, get_logger, initialize_logger
+from steppy.utils import cheap_hash, display_upstream_structure, persist_as_png, get_logger, initialize_logger
 
 initialize_logger()
 logger = get_logger()
 
+# Steps with parallel_safe=False hold it while their transformers run
+_parallel_unsafe_lock = threading.RLock()
+
+# pickled, so that output keys of any hashable type are read back unchanged
+_OUTPUT_INDEX = '_index.pkl'
+
+# file, and its modification time, each transformer object was last loaded from or persisted to
+_transformer_sources = weakref.WeakKeyDictionary()
+
+# raised by joblib.hash for objects that cannot be pickled, like locks, open files or local functions
+_UNHASHABLE_ERRORS = (TypeError, AttributeError, pickle.PicklingError)
+
+# attributes added to Step since Steps were pickled with their __dict__ as state, set on Steps unpickled from it
+_PICKLED_STEP_DEFAULTS = {
+    'output_directory': None,
+    'persist_output_in_background': False,
+    'mmap_output': False,
+    'compress_output': 0,
+    'read_only_output': False,
+    'n_jobs': 1,
+    'backend': 'threading',
+    'parallel_safe': True,
+    '_paths_cache': None
+}
+
+# experiment directories prepared by Steps of this process, Steps sharing one skip filesystem checks
+_prepared_experiment_directories = set()
+_prepared_experiment_directories_lock = threading.Lock()
+
 DEFAULT_TRAINING_SETUP = {
     'is_fittable': True,
     'force_fitting': True,
@@ -28,16 +66,21 @@ class Step:
     1. design multiple input/output data flows and connections between Steps.
     2. handle persistence and caching of transformer and intermediate results.
 
-    Step executes `fit_transform` method inspired by the sklearn on every step recursively
-    starting from the very last Step and making its way forward through the `input_steps`.
+    Step executes `fit_transform` method inspired by the sklearn on every upstream step,
+    in an order where each Step runs after all of its `input_steps`. Upstream Steps whose
+    output is already cached or persisted are not executed at all. Upstream Steps of subclasses
+    that override `fit_transform` or `transform` are run by calling these methods.
     One can easily debug the data flow by plotting the pipeline graph
     (see: :func:`~steppy.utils.persist_as_png`) or return step in a jupyter notebook cell.
 
     Attributes:
         transformer (obj): object that inherits from BaseTransformer or Step instance.
             When Step instance is passed, transformer from that Step will be copied and used to
-            perform transformations. It is useful when both train and valid data are passed in
-            one pipeline (common situation in deep learning).
+            perform transformations. It is never fitted by this Step, ``fit_transform`` only transforms
+            with it. Its persisted transformer file is hard-linked, or copied when linking is not possible,
+            when this Step first needs it, so that Step may be fitted later. In one pipeline, this Step
+            runs after that Step. It is useful when both train and valid data are passed in one pipeline
+            (common situation in deep learning).
 
         name (str): Step name.
             Each step in a pipeline must have a unique name. It is name of the persisted
@@ -88,6 +131,9 @@ class Step:
             list of Step instances, default is empty list.
             Current Step will combine output from `input_steps` and `input_data` using `adapter`.
             Then pass it to the transformer methods `fit_transform` and `transform`.
+            Upstream pipeline structure is cached, so assign a new list instead of modifying
+            ``input_steps`` in place when rewiring the pipeline, or call
+            :meth:`~steppy.base.Step.invalidate_upstream_structure` afterwards.
 
             Example:
 
@@ -130,7 +176,10 @@ class Step:
                 When working with large datasets, cache might be very large.
 
         persist_output (bool): If True, persist Step output to disk under the
-            ``<experiment_directory>/output/<name>`` directory.
+            ``<experiment_directory>/output/<name>`` directory. Every value of the output
+            dictionary is written to a separate file. When the output is loaded, values are read
+            only when a following Step accesses them, while `fit_transform` and `transform` of
+            this Step return all of them in a dict.
             Default ``False``: do not persist any files to disk.
             If True then Step output dictionary will be persisted to the
             ``<experiment_directory>/output/<name>`` directory, after transform method of the Step
@@ -141,17 +190,51 @@ class Step:
             Warning:
                 When working with large datasets, cache might be very large.
 
+        persist_output_in_background (bool): If True, persisted output (see `persist_output`) is
+            written in a background thread, while the following Steps run. All outputs are written
+            before `fit_transform` or `transform` returns.
+            Default ``False``: output is written before any following Step runs.
+            Only use it when transformers of the following Steps do not modify their inputs in
+            place, otherwise the persisted output may be modified while it is being written.
+
         load_persisted_output (bool): If True, Step output dictionary already persisted to the
             ``<experiment_directory>/output/<name>`` will be loaded when Step is called.
             Default ``False``: do not load persisted output.
             Useful when debugging and working with ensemble models or time consuming feature
             extraction. One can easily persist already computed pieces of the pipeline and save
             time by loading them instead of calculating.
+            Persisted output is loaded only when it was produced by the same upstream pipeline,
+            that is the same transformer classes with the same ``get_params()`` (if transformers
+            implement it), input names, adapters and input data. Otherwise it is computed again.
+            If this cannot be checked, for example when input data cannot be pickled or is not
+            passed to the Step, or the output was persisted as a single file by an older version
+            of steppy, persisted output is loaded and a message is logged.
 
             Warning:
-                Re-running the same step on new data with `load_persisted_output` set ``True``
-                may lead to errors when output from old data are loaded while user would expect
-                the pipeline to use new data instead.
+                Large numpy arrays and data frames in the input data are compared by a sample
+                of their content (see :func:`~steppy.utils.cheap_hash`). Re-running the same step
+                on data that differs only outside of that sample with `load_persisted_output` set
+                ``True`` loads output computed from old data.
+
+        mmap_output (bool): If True, numpy arrays in the persisted output are memory-mapped
+            in read-only mode when the output is loaded (see `load_persisted_output`), instead of
+            being read into memory. Loading is then almost instant and the pages are shared
+            between processes that load the same output.
+            Default ``False``: load arrays into memory, so that they can be modified.
+
+        compress_output (int): zlib compression level, from 0 to 9, of values in the persisted
+            output that are not numpy arrays (see `persist_output`). Numpy arrays are never
+            compressed, so that they can still be memory-mapped (see `mmap_output`).
+            Default ``0``: no compression. Level ``1`` or ``3`` is usually enough to shrink pickled
+            Python objects considerably, at a fraction of the cost of higher levels.
+
+        read_only_output (bool): If True, numpy arrays in the output computed by the transformer
+            are marked as read-only before they are passed to downstream Steps. Downstream
+            transformers then share the arrays and are not allowed to modify them in place: doing
+            so raises ``ValueError``, so they do not need to copy them defensively. Arrays that the
+            transformer passes through from its inputs belong to the caller or to input Steps,
+            they are left as they are.
+            Default ``False``: arrays are passed as they are.
 
         force_fitting (bool): If True, Step transformer will be fitted (via `fit_transform`)
             even if ``<experiment_directory>/transformers/<step_name>`` exists.
@@ -160,7 +243,38 @@ class Step:
             on a previous Step and fit current Step multiple times. This is a typical scenario
             for tuning hyperparameters for an ensemble model trained on the output from first
             level models or a model build on features that are time consuming to compute.
+
+        n_jobs (int): Number of threads used to execute independent upstream Steps, when
+            `fit_transform` or `transform` is called on this Step.
+            Default ``1``: execute upstream Steps one by one. ``-1`` means using as many threads
+            as there are processors.
+            Each Step is started as soon as all of its input Steps are finished. Threads help
+            when transformers release the GIL (numpy, scikit-learn, I/O).
+
+        backend (str): How transformers of independent upstream Steps are executed when
+            ``n_jobs != 1``. One of:
+
+            * ``'threading'``: in threads of the current process (default),
+            * ``'multiprocessing'``: in a pool of worker processes, which is reused between calls
+              (joblib's loky executor). Useful for CPU-bound, pure Python transformers.
+              Transformers and their inputs must be picklable with cloudpickle. Transformer fitted
+              in a worker process is sent back and replaces ``step.transformer``, so a transformer
+              object shared with other Steps or held by the caller is not shared anymore. Such
+              transformers are not supported with this backend.
+
+        parallel_safe (bool): If False, transformer of this Step is always executed in the
+            current process, and never at the same time as transformer of another Step with
+            ``parallel_safe=False``. Useful for transformers that need exclusive access to
+            a resource, like a GPU.
+            Default ``True``.
     """
+    __slots__ = ('_name', '_transformer', '_transformer_step', 'experiment_directory', 'output_directory',
+                 '_input_steps', '_input_data', 'adapter', 'is_fittable', 'force_fitting', 'persist_output',
+                 'cache_output', 'load_persisted_output', 'mmap_output', 'n_jobs', 'backend', 'output', '_mode',
+                 '_upstream_plan_cache', 'parallel_safe', '_paths_cache', 'compress_output', 'read_only_output',
+                 'persist_output_in_background', '__weakref__')
+
+    _structure_version = 0
 
     def __init__(self,
                  transformer,
@@ -175,8 +289,16 @@ class Step:
                  force_fitting=True,
 
                  persist_output=False,
+                 persist_output_in_background=False,
                  cache_output=False,
-                 load_persisted_output=False):
+                 load_persisted_output=False,
+                 mmap_output=False,
+                 compress_output=0,
+                 read_only_output=False,
+
+                 n_jobs=1,
+                 backend='threading',
+                 parallel_safe=True):
 
         self.name = self._format_step_name(name, transformer)
 
@@ -186,7 +308,7 @@ class Step:
                 'be str, got {} instead.'.format(self.name, type(experiment_directory))
         else:
             experiment_directory = os.path.join(os.path.expanduser("~"), '.steppy')
-            logger.info('Using default experiment directory: {}'.format(experiment_directory))
+            logger.info('Using default experiment directory: %s', experiment_directory)
 
         if output_directory is not None:
             assert isinstance(output_directory, str),\
@@ -206,24 +328,49 @@ class Step:
                                                'got {} instead.'.format(self.name, type(cache_output))
         assert isinstance(persist_output, bool), 'Step {} error, persist_output must be bool, ' \
                                                  'got {} instead.'.format(self.name, type(persist_output))
+        assert isinstance(persist_output_in_background, bool),\
+            'Step {} error, persist_output_in_background ' \
+            'must be bool, got {} instead.'.format(self.name, type(persist_output_in_background))
         assert isinstance(load_persisted_output, bool),\
             'Step {} error, load_persisted_output ' \
             'must be bool, got {} instead.'.format(self.name, type(load_persisted_output))
+        assert isinstance(mmap_output, bool), 'Step {} error, mmap_output must be bool, ' \
+                                              'got {} instead.'.format(self.name, type(mmap_output))
+        assert isinstance(compress_output, int) and 0 <= compress_output <= 9,\
+            'Step {} error, compress_output must be int from 0 to 9, got {} instead.'.format(self.name, compress_output)
+        assert isinstance(read_only_output, bool), 'Step {} error, read_only_output must be bool, ' \
+                                                   'got {} instead.'.format(self.name, type(read_only_output))
         assert isinstance(force_fitting, bool), 'Step {} error, force_fitting must be bool, ' \
                                                 'got {} instead.'.format(self.name, type(force_fitting))
+        assert isinstance(n_jobs, int) and (n_jobs >= 1 or n_jobs == -1),\
+            'Step {} error, n_jobs must be positive int or -1, got {} instead.'.format(self.name, n_jobs)
+        assert backend in ('threading', 'multiprocessing'),\
+            'Step {} error, backend must be "threading" or "multiprocessing", ' \
+            'got {} instead.'.format(self.name, backend)
+        assert isinstance(parallel_safe, bool), 'Step {} error, parallel_safe must be bool, ' \
+                                                'got {} instead.'.format(self.name, type(parallel_safe))
 
-        logger.info('Initializing Step {}'.format(self.name))
+        logger.info('Initializing Step %s', self.name)
 
         self.transformer = transformer
         self.output_directory = output_directory
+        self._upstream_plan_cache = None
+        self._paths_cache = None
         self.input_steps = input_steps or []
         self.input_data = input_data or []
         self.adapter = adapter
         self.is_fittable = is_fittable
         self.cache_output = cache_output
         self.persist_output = persist_output
+        self.persist_output_in_background = persist_output_in_background
         self.load_persisted_output = load_persisted_output
+        self.mmap_output = mmap_output
+        self.compress_output = compress_output
+        self.read_only_output = read_only_output
         self.force_fitting = force_fitting
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.parallel_safe = parallel_safe
 
         self.output = None
         self.experiment_directory = os.path.join(experiment_directory)
@@ -231,28 +378,98 @@ class Step:
         self._mode = 'train'
 
         self._validate_upstream_names()
-        logger.info('Step {} initialized'.format(self.name))
+        logger.info('Step %s initialized', self.name)
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        if hasattr(self, '_name'):
+            # Steps are looked up by name in cached upstream structure of every Step
+            Step._structure_version += 1
+        self._name = name
+
+    @property
+    def transformer(self):
+        if self._transformer_step is not None:
+            return self._transformer_step.transformer
+        return self._transformer
+
+    @transformer.setter
+    def transformer(self, transformer):
+        # Step passed as transformer lends its transformer, which is looked up on every access,
+        # so that this Step uses it after the other Step is fitted.
+        transformer_step = transformer if isinstance(transformer, Step) else None
+        if hasattr(self, '_transformer_step') and transformer_step is not self._transformer_step:
+            # Step runs after the Step it takes transformer from, so cached upstream order changes
+            Step._structure_version += 1
+        if transformer_step is not None:
+            self._transformer, self._transformer_step = None, transformer_step
+        else:
+            self._transformer, self._transformer_step = transformer, None
+
+    @property
+    def input_steps(self):
+        return self._input_steps
+
+    @input_steps.setter
+    def input_steps(self, input_steps):
+        if hasattr(self, '_input_steps'):
+            if self._is_upstream_of(input_steps):
+                msg = 'Step {} error, connecting input_steps {} would create a cycle.'.format(
+                    self.name, [input_step.name for input_step in input_steps])
+                raise StepError(msg)
+            # rewiring an existing Step invalidates cached upstream structure of every Step
+            Step._structure_version += 1
+        self._input_steps = input_steps
+
+    @property
+    def input_data(self):
+        return self._input_data
+
+    @input_data.setter
+    def input_data(self, input_data):
+        if hasattr(self, '_input_data'):
+            Step._structure_version += 1
+        self._input_data = input_data
 
     @property
     def experiment_directory_transformers_step(self):
-        directory = os.path.join(self.experiment_directory, 'transformers')
-        os.makedirs(directory, exist_ok=True)
-        return os.path.join(directory, self.name)
+        paths = self._paths
+        os.makedirs(paths.transformers_dirpath, exist_ok=True)
+        return paths.transformers_filepath
 
     @property
     def experiment_directory_output_step(self):
-        directory = os.path.join(self.experiment_directory, 'output')
-        if self.output_directory is not None:
-            os.makedirs(os.path.join(directory, self.output_directory), exist_ok=True)
-            return os.path.join(directory, self.output_directory, self.name)
+        paths = self._paths
+        if paths.output_dirpath is None:
+            return None
+        os.makedirs(paths.output_dirpath, exist_ok=True)
+        return paths.output_filepath
 
-        if self._mode == 'train':
-            os.makedirs(os.path.join(directory, 'train'), exist_ok=True)
-            return os.path.join(directory, 'train', self.name)
-
-        if self._mode == 'inference':
-            os.makedirs(os.path.join(directory, 'inference'), exist_ok=True)
-            return os.path.join(directory, 'inference', self.name)
+    @property
+    def _paths(self):
+        # paths are joined again only when one of the attributes they depend on changes
+        key = (self.experiment_directory, self.output_directory, self._mode, self.name)
+        paths = self._paths_cache
+        if paths is None or paths.key != key:
+            transformers_dirpath = os.path.join(self.experiment_directory, 'transformers')
+            output_dirpath = os.path.join(self.experiment_directory, 'output')
+            if self.output_directory is not None:
+                output_dirpath = os.path.join(output_dirpath, self.output_directory)
+            elif self._mode in ('train', 'inference'):
+                output_dirpath = os.path.join(output_dirpath, self._mode)
+            else:
+                output_dirpath = None
+            paths = self._paths_cache = _StepPaths(
+                key=key,
+                transformers_dirpath=transformers_dirpath,
+                transformers_filepath=os.path.join(transformers_dirpath, self.name),
+                output_dirpath=output_dirpath,
+                output_filepath=os.path.join(output_dirpath, self.name) if output_dirpath is not None else None)
+        return paths
 
     @property
     def upstream_structure(self):
@@ -266,22 +483,44 @@ class Step:
             - value of ``'edges'`` is set of tuples ``(input_step.name, self.name)``
             - value of ``'nodes'`` is set of all step names upstream to this Step
         """
-        structure_dict = {'edges': set(),
-                          'nodes': set()}
-        structure_dict = self._build_structure_dict(structure_dict)
-        return structure_dict
+        plan = self._upstream_plan
+        if plan.structure is None:
+            structure_dict = {'edges': set(),
+                              'nodes': set()}
+            for step in plan.steps:
+                structure_dict['nodes'].add(step.name)
+                for input_step in step.input_steps:
+                    structure_dict['edges'].add((input_step.name, step.name))
+                for input_data in step.input_data:
+                    structure_dict['nodes'].add(input_data)
+                    structure_dict['edges'].add((input_data, step.name))
+            plan.structure = structure_dict
+        return {'edges': set(plan.structure['edges']),
+                'nodes': set(plan.structure['nodes'])}
 
     @property
     def all_upstream_steps(self):
         """Build dictionary with all Step instances that are upstream to `self`.
 
+        Upstream Steps are collected once and reused until the pipeline is rewired.
+        Steps are ordered topologically, that is every Step comes after all of its input Steps.
+
         Returns:
             all_upstream_steps (dict): dictionary where keys are Step names (str) and values are Step
             instances (obj)
         """
-        all_steps_ = {}
-        all_steps_ = self._get_steps(all_steps_)
-        return all_steps_
+        return dict(self._upstream_plan.steps_by_name)
+
+    @property
+    def _upstream_plan(self):
+        plan = self._upstream_plan_cache
+        if plan is None or plan.version != Step._structure_version:
+            steps = self._get_steps()
+            positions = {id(step): i for i, step in enumerate(steps)}
+            inputs = tuple(tuple((input_step.name, positions[id(input_step)]) for input_step in step.input_steps)
+                           for step in steps)
+            plan = self._upstream_plan_cache = _UpstreamPlan(Step._structure_version, tuple(steps), inputs)
+        return plan
 
     @property
     def transformer_is_persisted(self):
@@ -305,7 +544,8 @@ class Step:
         """(bool): True if step output exists under the ``<experiment_directory>/output/<mode>/<name>``.
             See :attr:`~steppy.base.Step.persist_output`.
         """
-        return os.path.exists(self.experiment_directory_output_step)
+        filepath = self.experiment_directory_output_step
+        return os.path.isfile(filepath) or os.path.exists(os.path.join(filepath, _OUTPUT_INDEX))
 
     def fit_transform(self, data):
         """Fit the model and transform data or load already processed data.
@@ -332,36 +572,13 @@ class Step:
         if data:
             assert isinstance(data, dict), 'Step {}, "data" argument in the "fit_transform()" method must be dict, ' \
                                            'got {} instead.'.format(self.name, type(data))
-        logger.info('Step {}, working in "{}" mode'.format(self.name, self._mode))
 
         if self._mode == 'inference':
             ValueError('Step {}, you are in "{}" mode, where you cannot run "fit".'
                        'Please change mode to "train" to enable fitting.'
                        'Use: "step.set_mode_train()" then "step.fit_transform()"'.format(self.name, self._mode))
 
-        if self.output_is_cached and not self.force_fitting:
-            logger.info('Step {} using cached output'.format(self.name))
-            step_output_data = self.output
-        elif self.output_is_persisted and self.load_persisted_output and not self.force_fitting:
-            logger.info('Step {} loading persisted output from {}'.format(self.name,
-                                                                          self.experiment_directory_output_step))
-            step_output_data = self._load_output(self.experiment_directory_output_step)
-        else:
-            step_inputs = {}
-            if self.input_data is not None:
-                for input_data_part in self.input_data:
-                    step_inputs[input_data_part] = data[input_data_part]
-
-            for input_step in self.input_steps:
-                step_inputs[input_step.name] = input_step.fit_transform(data)
-
-            if self.adapter:
-                step_inputs = self._adapt(step_inputs)
-            else:
-                step_inputs = self._unpack(step_inputs)
-            step_output_data = self._fit_transform_operation(step_inputs)
-        logger.info('Step {}, fit and transform completed'.format(self.name))
-        return step_output_data
+        return self._run_upstream(data, mode='fit_transform')
 
     def transform(self, data):
         """Transforms data or loads already processed data.
@@ -391,31 +608,8 @@ class Step:
         if data:
             assert isinstance(data, dict), 'Step {}, "data" argument in the "transform()" method must be dict, ' \
                                            'got {} instead.'.format(self.name, type(data))
-        logger.info('Step {}, working in "{}" mode'.format(self.name, self._mode))
-
-        if self.output_is_cached:
-            logger.info('Step {} using cached output'.format(self.name))
-            step_output_data = self.output
-        elif self.output_is_persisted and self.load_persisted_output:
-            logger.info('Step {} loading persisted output from {}'.format(self.name,
-                                                                          self.experiment_directory_output_step))
-            step_output_data = self._load_output(self.experiment_directory_output_step)
-        else:
-            step_inputs = {}
-            if self.input_data is not None:
-                for input_data_part in self.input_data:
-                    step_inputs[input_data_part] = data[input_data_part]
-
-            for input_step in self.input_steps:
-                step_inputs[input_step.name] = input_step.transform(data)
 
-            if self.adapter:
-                step_inputs = self._adapt(step_inputs)
-            else:
-                step_inputs = self._unpack(step_inputs)
-            step_output_data = self._transform_operation(step_inputs)
-        logger.info('Step {}, transform completed'.format(self.name))
-        return step_output_data
+        return self._run_upstream(data, mode='transform')
 
     def set_mode_train(self):
         """Applies 'train' mode to all upstream Steps including this Step
@@ -444,14 +638,13 @@ class Step:
         """
         self.clean_cache_upstream()
         self.set_mode_train()
-        for step_obj in self.all_upstream_steps.values():
+        for step_obj in self._upstream_plan.steps:
             step_obj.is_fittable = DEFAULT_TRAINING_SETUP['is_fittable']
             step_obj.force_fitting = DEFAULT_TRAINING_SETUP['force_fitting']
             step_obj.persist_output = DEFAULT_TRAINING_SETUP['persist_output']
             step_obj.cache_output = DEFAULT_TRAINING_SETUP['cache_output']
             step_obj.load_persisted_output = DEFAULT_TRAINING_SETUP['load_persisted_output']
-        logger.info('Step {}, reset all upstream Steps to default training parameters, '
-                    'including this Step'.format(self.name))
+        logger.info('Step %s, reset all upstream Steps to default training parameters, including this Step', self.name)
         return self
 
     def set_parameters_upstream(self, parameters):
@@ -459,10 +652,14 @@ class Step:
         Parameters is dict() where key is Step attribute, and value is new value to set.
         """
         assert isinstance(parameters, dict), 'parameters must be dict, got {} instead'.format(type(parameters))
-        for step_obj in self.all_upstream_steps.values():
-            for key in step_obj.__dict__.keys():
-                if key in list(parameters.keys()):
-                    step_obj.__dict__[key] = parameters[key]
+        for step_obj in self._upstream_plan.steps:
+            for key, value in parameters.items():
+                # private attributes, like _input_steps, would bypass checks done by their properties
+                if key.startswith('_'):
+                    continue
+                if key in _get_slots(type(step_obj)) or key in getattr(step_obj, '__dict__', ()) \
+                        or _is_settable_property(type(step_obj), key):
+                    setattr(step_obj, key, value)
                     if key == 'experiment_directory':
                         step_obj._prepare_experiment_directories()
         logger.info('set new values to all upstream Steps including this Step.')
@@ -471,17 +668,28 @@ class Step:
     def clean_cache_step(self):
         """Clean cache for current step.
         """
-        logger.info('Step {}, cleaning cache'.format(self.name))
+        logger.info('Step %s, cleaning cache', self.name)
         self.output = None
         return self
 
     def clean_cache_upstream(self):
         """Clean cache for all steps that are upstream to `self`.
         """
-        logger.info('Cleaning cache for the entire upstream pipeline')
-        for step in self.all_upstream_steps.values():
-            logger.info('Step {}, cleaning cache'.format(step.name))
+        upstream_steps = self._upstream_plan.steps
+        for step in upstream_steps:
             step.output = None
+        logger.info('Step %s, cleaned cache for the entire upstream pipeline (%s Steps)',
+                    self.name, len(upstream_steps))
+        return self
+
+    def invalidate_upstream_structure(self):
+        """Drop upstream pipeline structure cached by all Steps.
+
+        Assigning ``input_steps`` or ``input_data`` does it automatically. Call it after
+        modifying these lists in place.
+        """
+        Step._structure_version += 1
+        logger.info('Step %s, invalidated cached upstream pipeline structure', self.name)
         return self
 
     def get_step_by_name(self, name):
@@ -497,17 +705,18 @@ class Step:
         """
         self._validate_step_name(name)
         name = str(name)
+        steps_by_name = self._upstream_plan.steps_by_name
         try:
-            return self.all_upstream_steps[name]
+            return steps_by_name[name]
         except KeyError as e:
             msg = 'No Step with name "{}" found. ' \
-                  'You have following Steps: {}'.format(name, list(self.all_upstream_steps.keys()))
+                  'You have following Steps: {}'.format(name, list(steps_by_name.keys()))
             raise StepError(msg) from e
 
     def persist_upstream_structure(self):
         """Persist json file with the upstream steps structure, that is step names and their connections."""
         persist_dir = os.path.join(self.experiment_directory, '{}_upstream_structure.json'.format(self.name))
-        logger.info('Step {}, saving upstream pipeline structure to {}'.format(self.name, persist_dir))
+        logger.info('Step %s, saving upstream pipeline structure to %s', self.name, persist_dir)
         joblib.dump(self.upstream_structure, persist_dir)
 
     def persist_upstream_diagram(self, filepath):
@@ -523,117 +732,434 @@ class Step:
             'Step {} error, filepath must be str. Got {} instead'.format(self.name, type(filepath))
         persist_as_png(self.upstream_structure, filepath)
 
-    def _fit_transform_operation(self, step_inputs):
-        if self.is_fittable:
-            if self.transformer_is_persisted and not self.force_fitting:
-                logger.info('Step {}, loading transformer from the {}'
-                            .format(self.name, self.experiment_directory_transformers_step))
-                self.transformer.load(self.experiment_directory_transformers_step)
-                logger.info('Step {}, transforming...'.format(self.name))
-
-                try:
-                    step_output_data = self.transformer.transform(**step_inputs)
-                except Exception as e:
-                    msg = 'Step {}, Transformer "{}" error ' \
-                          'during "transform()" operation.'.format(self.name, self.transformer.__class__.__name__)
-                    raise StepError(msg) from e
-
-                logger.info('Step {}, transforming completed'.format(self.name))
+    def _run_upstream(self, data, mode):
+        # Steps may be shared by pipelines that run at the same time, so state of this run
+        # is kept in the context passed to them, and never set on the Steps.
+        upstream_steps = self._upstream_plan.steps
+        context = _RunContext()
+        if any(step.persist_output or step.load_persisted_output for step in upstream_steps):
+            context.fingerprints = dict(zip(upstream_steps, self._get_fingerprints(data)))
+        if any(step.persist_output and step.persist_output_in_background for step in upstream_steps):
+            context.output_writer = _OutputWriter()
+        prefetcher = None
+        try:
+            steps_to_run = self._get_steps_to_run(mode, context)
+            prefetcher = self._start_prefetching(steps_to_run, mode)
+            step_output_data = self._execute_upstream(data, steps_to_run, mode, context)
+            if isinstance(step_output_data, _PersistedOutput):
+                # persisted output is loaded lazily between Steps, but callers get a dict
+                step_output_data = dict(step_output_data)
+            if context.output_writer is not None:
+                context.output_writer.wait()
+            return step_output_data
+        finally:
+            if prefetcher is not None:
+                prefetcher.join()
+            if context.output_writer is not None:
+                context.output_writer.shutdown()
+
+    def _get_fingerprints(self, data):
+        # Fingerprint of a Step describes the pipeline and the data that produce its output,
+        # so it is derived from fingerprints of its input Steps.
+        # It is None when it cannot be computed, for example when data does not contain
+        # a part that only a Step with persisted output reads, or cannot be pickled.
+        # Persisted outputs of such Step and of Steps downstream of it are then not checked.
+        plan = self._upstream_plan
+        data_fingerprints = {}
+        fingerprints = []
+        for step, inputs in zip(plan.steps, plan.inputs):
+            for input_data_part in step.input_data:
+                if input_data_part not in data_fingerprints:
+                    data_fingerprints[input_data_part] = _fingerprint_data_part(data, input_data_part)
+            input_fingerprints = tuple((name, fingerprints[j]) for name, j in inputs)
+            input_data_fingerprints = tuple((input_data_part, data_fingerprints[input_data_part])
+                                            for input_data_part in step.input_data)
+            if any(fingerprint is None for _, fingerprint in input_fingerprints + input_data_fingerprints):
+                fingerprints.append(None)
+                continue
+            transformer = step.transformer
+            get_params = getattr(transformer, 'get_params', None)
+            try:
+                fingerprints.append(joblib.hash((
+                    transformer.__class__.__module__,
+                    transformer.__class__.__name__,
+                    get_params() if callable(get_params) else None,
+                    input_fingerprints,
+                    input_data_fingerprints,
+                    step.adapter.adapting_recipes if step.adapter is not None else None,
+                )))
+            except _UNHASHABLE_ERRORS:
+                fingerprints.append(None)
+        return fingerprints
+
+    def _start_prefetching(self, steps_to_run, mode):
+        # Persisted outputs that will be loaded are known before any Step runs, so the OS
+        # is asked to read them into the page cache in the background.
+        if not hasattr(os, 'posix_fadvise'):
+            return None
+        steps = self._upstream_plan.steps
+        filepaths = [steps[i].experiment_directory_output_step for i, input_recipe in steps_to_run
+                     if input_recipe is None and not steps[i]._uses_cached_output(mode)
+                     and (steps[i] is self or not steps[i]._overrides_run(mode))]
+        if not filepaths:
+            return None
+        prefetcher = threading.Thread(target=_prefetch, args=(filepaths,), daemon=True)
+        prefetcher.start()
+        return prefetcher
+
+    def _execute_upstream(self, data, steps_to_run, mode, context):
+        outputs = _RunOutputs(steps_to_run, len(self._upstream_plan.steps))
+        if self.n_jobs == 1:
+            self._run_steps(data, outputs, steps_to_run, mode, context)
+        else:
+            max_workers = self.n_jobs if self.n_jobs > 0 else os.cpu_count()
+            process_pool = _get_process_pool(max_workers) if self.backend == 'multiprocessing' else None
+            chains, chain_inputs = self._group_into_chains(steps_to_run, self._get_transformer_inputs(steps_to_run))
+            n_waiting = [len(inputs) for inputs in chain_inputs]
+            consumers = defaultdict(list)
+            for k, inputs in enumerate(chain_inputs):
+                for input_k in inputs:
+                    consumers[input_k].append(k)
+            ready = [k for k, n in enumerate(n_waiting) if n == 0]
+            running = {}
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                while ready or running:
+                    if len(ready) == 1 and not running:
+                        # nothing else can run at the moment, so there is no point in handing it over
+                        self._run_steps(data, outputs, chains[ready[0]], mode, context)
+                        finished = [ready[0]]
+                    else:
+                        for k in ready:
+                            running[executor.submit(self._run_steps, data, outputs, chains[k], mode, context,
+                                                    process_pool)] = k
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        finished = []
+                        for future in done:
+                            future.result()
+                            finished.append(running.pop(future))
+                    ready = []
+                    for k in finished:
+                        for consumer_k in consumers[k]:
+                            n_waiting[consumer_k] -= 1
+                            if n_waiting[consumer_k] == 0:
+                                ready.append(consumer_k)
+        return outputs[-1]
+
+    def _run_steps(self, data, outputs, steps_to_run, mode, context, process_pool=None):
+        steps = self._upstream_plan.steps
+        for i, input_recipe in steps_to_run:
+            if input_recipe is None and steps[i] is not self and steps[i]._overrides_run(mode):
+                outputs[i] = getattr(steps[i], mode)(data)
             else:
-                logger.info('Step {}, fitting and transforming...'.format(self.name))
-
-                try:
-                    step_output_data = self.transformer.fit_transform(**step_inputs)
-                except Exception as e:
-                    msg = 'Step {}, Transformer "{}" error ' \
-                          'during "fit_transform()" operation.'.format(self.name, self.transformer.__class__.__name__)
-                    raise StepError(msg) from e
-
-                logger.info('Step {}, fitting and transforming completed'.format(self.name))
-                logger.info('Step {}, persisting transformer to the {}'
-                            .format(self.name, self.experiment_directory_transformers_step))
-                self.transformer.persist(self.experiment_directory_transformers_step)
+                outputs[i] = steps[i]._run_step(data, outputs.collect(input_recipe), mode, context, process_pool)
+
+    def _get_steps_to_run(self, mode, context):
+        # Walks the plan backwards, from this Step (always the last one) towards the pipeline inputs.
+        # Returns (position, input recipe) pairs in execution order; input recipe is None
+        # for Steps that use their cached or persisted output, and for input Steps of subclasses
+        # that override fit_transform or transform, which are run through these methods.
+        plan = self._upstream_plan
+        steps, inputs = plan.steps, plan.inputs
+        required = [False] * len(steps)
+        required[-1] = True
+        steps_to_run = []
+        for i in reversed(range(len(steps))):
+            if not required[i]:
+                continue
+            if steps[i]._uses_stored_output(mode, context) \
+                    or (steps[i] is not self and steps[i]._overrides_run(mode)):
+                steps_to_run.append((i, None))
+                continue
+            for _, j in inputs[i]:
+                required[j] = True
+            steps_to_run.append((i, inputs[i]))
+        steps_to_run.reverse()
+        return steps_to_run
+
+    def _get_transformer_inputs(self, steps_to_run):
+        # Step that uses transformer of another Step of the pipeline must wait until that Step is fitted.
+        steps = self._upstream_plan.steps
+        positions = {id(step): i for i, step in enumerate(steps)}
+        return {i: positions[id(steps[i]._transformer_step)] for i, _ in steps_to_run
+                if id(steps[i]._transformer_step) in positions}
+
+    @staticmethod
+    def _group_into_chains(steps_to_run, transformer_inputs=None):
+        # Steps form chains, where each Step has a single input Step and is its only consumer.
+        # A chain is executed as one task, which is submitted as soon as all chains it takes inputs
+        # from are finished. Returns chains and, for each chain, positions of its input chains.
+        # transformer_inputs maps position of a Step to position of the Step it takes transformer from,
+        # such Step waits for that Step and always starts a chain.
+        transformer_inputs = transformer_inputs or {}
+        n_consumers = defaultdict(int)
+        for _, input_recipe in steps_to_run:
+            for j in {j for _, j in input_recipe or ()}:
+                n_consumers[j] += 1
+
+        chains, chain_of = [], {}
+        for i, input_recipe in steps_to_run:
+            input_positions = {j for _, j in input_recipe or ()}
+            if len(input_positions) == 1 and n_consumers[next(iter(input_positions))] == 1 \
+                    and i not in transformer_inputs:
+                chain = chain_of[next(iter(input_positions))]
+                chain.append((i, input_recipe))
+            else:
+                chain = [(i, input_recipe)]
+                chains.append(chain)
+            chain_of[i] = chain
+
+        chain_positions = {id(chain): k for k, chain in enumerate(chains)}
+        chain_inputs = []
+        for chain in chains:
+            i, input_recipe = chain[0]
+            input_positions = {j for _, j in input_recipe or ()}
+            if transformer_inputs.get(i) in chain_of:
+                input_positions.add(transformer_inputs[i])
+            chain_inputs.append({chain_positions[id(chain_of[j])] for j in input_positions})
+        return chains, chain_inputs
+
+    def _overrides_run(self, mode):
+        # fit_transform or transform overridden by a subclass
+        return getattr(type(self), mode) is not getattr(Step, mode)
+
+    def _uses_stored_output(self, mode, context):
+        return self._uses_cached_output(mode) or self._uses_persisted_output(mode, context)
+
+    def _uses_cached_output(self, mode):
+        return (mode == 'transform' or not self.force_fitting) and self.output_is_cached
+
+    def _uses_persisted_output(self, mode, context):
+        return (mode == 'transform' or not self.force_fitting) and self.load_persisted_output \
+            and self.output_is_persisted and self._persisted_output_is_current(context)
+
+    def _persisted_output_is_current(self, context):
+        filepath = self.experiment_directory_output_step
+        fingerprint = context.fingerprints.get(self)
+        if fingerprint is None or os.path.isfile(filepath):
+            # nothing to compare, outputs persisted as a single file have no fingerprint
+            logger.info('Step %s, could not check if persisted output was produced by the same pipeline, '
+                        'loading it anyway', self.name)
+            return True
+        if _read_output_index(filepath).get('fingerprint') == fingerprint:
+            return True
+        logger.info('Step %s, persisted output was produced by a different pipeline, it will be computed again',
+                    self.name)
+        return False
+
+    def _run_step(self, data, input_steps_outputs, mode, context, process_pool=None):
+        logger.info('Step %s, working in "%s" mode', self.name, self._mode)
+        if input_steps_outputs is None:
+            if self._uses_cached_output(mode):
+                logger.info('Step %s using cached output', self.name)
+                step_output_data = self.output
+            else:
+                logger.info('Step %s loading persisted output from %s',
+                            self.name, self.experiment_directory_output_step)
+                step_output_data = self._load_output(self.experiment_directory_output_step)
         else:
-            logger.info('Step {}, is not fittable, transforming...'.format(self.name))
-
-            try:
-                step_output_data = self.transformer.transform(**step_inputs)
-            except Exception as e:
-                msg = 'Step {}, Transformer "{}" error ' \
-                      'during "transform()" operation.'.format(self.name, self.transformer.__class__.__name__)
-                raise StepError(msg) from e
-
-            logger.info('Step {}, transforming completed'.format(self.name))
+            step_inputs = {input_data_part: data[input_data_part] for input_data_part in self.input_data}
+            step_inputs.update(input_steps_outputs)
 
-        assert isinstance(step_output_data, dict), 'Step {}, Transformer "{}", error. ' \
-            'Output from transformer must be dict, got {} instead'.format(self.name,
-                                                                          self.transformer.__class__.__name__,
-                                                                          type(step_output_data))
+            if self.adapter:
+                step_inputs = self._adapt(step_inputs)
+            else:
+                step_inputs = self._unpack(step_inputs)
+            # exact class only, subclasses may override transform
+            if type(self.transformer) is IdentityOperation:
+                step_output_data = self._identity_operation(step_inputs)
+            elif not self.parallel_safe:
+                with _parallel_unsafe_lock:
+                    step_output_data = getattr(self, self._operations[mode])(step_inputs)
+            elif process_pool is not None:
+                future = process_pool.submit(_run_operation, self._detached_copy(), step_inputs, mode)
+                step_output_data, transformer = future.result()
+                if self._transformer_step is None:
+                    # transformer of another Step is only loaded, never fitted, so it is not sent back
+                    self.transformer = transformer
+                    if self.is_fittable and self.transformer_is_persisted:
+                        # worker persisted the transformer or loaded it, so it is not loaded again
+                        _set_transformer_source(self.transformer, self.experiment_directory_transformers_step)
+            else:
+                step_output_data = getattr(self, self._operations[mode])(step_inputs)
+            self._store_output(step_output_data, context)
+            if self.read_only_output:
+                _set_read_only(step_output_data, step_inputs)
 
-        if self.cache_output:
-            logger.info('Step {}, caching output'.format(self.name))
-            self.output = step_output_data
-        if self.persist_output:
-            logger.info('Step {}, persisting output to the {}'
-                        .format(self.name, self.experiment_directory_output_step))
-            self._persist_output(step_output_data, self.experiment_directory_output_step)
+        if mode == 'fit_transform':
+            logger.info('Step %s, fit and transform completed', self.name)
+        else:
+            logger.info('Step %s, transform completed', self.name)
         return step_output_data
 
-    def _transform_operation(self, step_inputs):
+    def _fit_transform_operation(self, step_inputs):
+        if self._transformer_step is not None:
+            # transformer of another Step is used as fitted by that Step
+            return self._transform_operation(step_inputs)
         if self.is_fittable:
-            if self.transformer_is_persisted:
-                logger.info('Step {}, loading transformer from the {}'
-                            .format(self.name, self.experiment_directory_transformers_step))
-                self.transformer.load(self.experiment_directory_transformers_step)
-                logger.info('Step {}, transforming...'.format(self.name))
-
-                try:
-                    step_output_data = self.transformer.transform(**step_inputs)
-                except Exception as e:
-                    msg = 'Step {}, Transformer "{}" error ' \
-                          'during "transform()" operation.'.format(self.name, self.transformer.__class__.__name__)
-                    raise StepError(msg) from e
-
-                logger.info('Step {}, transforming completed'.format(self.name))
+            if self.transformer_is_persisted and not self.force_fitting:
+                self._load_transformer()
+                logger.info('Step %s, transforming...', self.name)
+                step_output_data = self._call_transformer('transform', step_inputs)
+                logger.info('Step %s, transforming completed', self.name)
             else:
+                logger.info('Step %s, fitting and transforming...', self.name)
+                step_output_data = self._call_transformer('fit_transform', step_inputs)
+                logger.info('Step %s, fitting and transforming completed', self.name)
+                self._persist_transformer()
+        else:
+            logger.info('Step %s, is not fittable, transforming...', self.name)
+            step_output_data = self._call_transformer('transform', step_inputs)
+            logger.info('Step %s, transforming completed', self.name)
+        return self._validate_output(step_output_data)
+
+    def _transform_operation(self, step_inputs):
+        if self.is_fittable:
+            self._link_transformer()
+            if not self.transformer_is_persisted:
                 raise ValueError('No transformer persisted with name: {}. '
                                  'Make sure that you have this transformer under the directory: {}'
                                  .format(self.name, self.experiment_directory_transformers_step))
-        else:
-            logger.info('Step {}, transforming...'.format(self.name))
-
-            try:
-                step_output_data = self.transformer.transform(**step_inputs)
-            except Exception as e:
-                msg = 'Step {}, Transformer "{}" error ' \
-                      'during "transform()" operation.'.format(self.name, self.transformer.__class__.__name__)
-                raise StepError(msg) from e
-
-            logger.info('Step {}, transforming completed'.format(self.name))
+            self._load_transformer()
+        logger.info('Step %s, transforming...', self.name)
+        step_output_data = self._call_transformer('transform', step_inputs)
+        logger.info('Step %s, transforming completed', self.name)
+        return self._validate_output(step_output_data)
+
+    def _persist_transformer(self):
+        filepath = self.experiment_directory_transformers_step
+        logger.info('Step %s, persisting transformer to the %s', self.name, filepath)
+        # file may be hard-linked with the transformer of another Step, so it must not be overwritten in place
+        if os.path.isfile(filepath) and os.stat(filepath).st_nlink > 1:
+            os.remove(filepath)
+        self.transformer.persist(filepath)
+        # transformer in memory is the one just persisted, so there is no need to load it before transform
+        if os.path.isfile(filepath):
+            _set_transformer_source(self.transformer, filepath)
+
+    def _link_transformer(self):
+        # Transformer of another Step is linked when it is needed, not when this Step is created,
+        # because the other Step may be fitted later.
+        step = self._transformer_step
+        if step is None:
+            return
+        step._link_transformer()
+        original_filepath = step.experiment_directory_transformers_step
+        copy_filepath = self.experiment_directory_transformers_step
+        if not os.path.isfile(original_filepath):
+            return
+        if os.path.abspath(original_filepath) == os.path.abspath(copy_filepath):
+            return
+        if os.path.exists(copy_filepath):
+            original_stat, copy_stat = os.stat(original_filepath), os.stat(copy_filepath)
+            if os.path.samestat(original_stat, copy_stat) or (copy_stat.st_mtime_ns == original_stat.st_mtime_ns
+                                                              and copy_stat.st_size == original_stat.st_size):
+                return
+            os.remove(copy_filepath)
+        logger.info('Step %s, copying transformer from %s to %s', self.name, original_filepath, copy_filepath)
+        # persisted transformers are never modified in place, so a hard link is as good as a copy
+        try:
+            os.link(original_filepath, copy_filepath)
+        except OSError:
+            _copy_file(original_filepath, copy_filepath)
+            # copy keeps modification time of the original, so it is known to be up to date
+            original_stat = os.stat(original_filepath)
+            os.utime(copy_filepath, ns=(original_stat.st_atime_ns, original_stat.st_mtime_ns))
+
+    def _load_transformer(self):
+        # Transformer already loaded from this Step's file is not loaded again, until the file changes.
+        # Transformer object may be shared by several Steps, so it is tracked where it was loaded from.
+        filepath = self.experiment_directory_transformers_step
+        if _get_transformer_source(self.transformer) == _transformer_source(filepath):
+            logger.info('Step %s, transformer from the %s is already loaded', self.name, filepath)
+            return
+        logger.info('Step %s, loading transformer from the %s', self.name, filepath)
+        self.transformer.load(filepath)
+        _set_transformer_source(self.transformer, filepath)
+
+    def _call_transformer(self, method_name, step_inputs):
+        try:
+            return getattr(self.transformer, method_name)(**step_inputs)
+        except Exception as e:
+            msg = 'Step {}, Transformer "{}" error ' \
+                  'during "{}()" operation.'.format(self.name, self.transformer.__class__.__name__, method_name)
+            raise StepError(msg) from e
 
+    def _validate_output(self, step_output_data):
         assert isinstance(step_output_data, dict), 'Step {}, Transformer "{}", error. ' \
             'Output from transformer must be dict, got {} instead'.format(self.name,
                                                                           self.transformer.__class__.__name__,
                                                                           type(step_output_data))
+        return step_output_data
 
+    def _identity_operation(self, step_inputs):
+        # there is nothing to call, fit or load, inputs are copied because they may belong to input Step
+        logger.info('Step %s, passing inputs through', self.name)
+        return dict(step_inputs)
+
+    def _store_output(self, step_output_data, context):
         if self.cache_output:
-            logger.info('Step {}, caching output'.format(self.name))
+            logger.info('Step %s, caching output', self.name)
             self.output = step_output_data
         if self.persist_output:
-            logger.info('Step {}, persisting output to the {}'
-                        .format(self.name, self.experiment_directory_output_step))
-            self._persist_output(step_output_data, self.experiment_directory_output_step)
-        return step_output_data
+            filepath = self.experiment_directory_output_step
+            fingerprint = context.fingerprints.get(self)
+            logger.info('Step %s, persisting output to the %s', self.name, filepath)
+            if self.persist_output_in_background:
+                context.output_writer.submit(self._persist_output, step_output_data, filepath, fingerprint)
+            else:
+                self._persist_output(step_output_data, filepath, fingerprint)
+
+    def _detached_copy(self):
+        # Step without its upstream pipeline, cheap to send to a worker process
+        step = copy.copy(self)
+        if self._transformer_step is not None:
+            step._transformer_step = self._transformer_step._detached_copy()
+        step._input_steps = []
+        step._upstream_plan_cache = None
+        step.adapter = None
+        step.output = None
+        return step
 
     def _load_output(self, filepath):
-        logger.info('Step {}, loading output from {}'.format(self.name, filepath))
-        return joblib.load(filepath)
-
-    def _persist_output(self, output_data, filepath):
-        joblib.dump(output_data, filepath)
+        logger.info('Step %s, loading output from %s', self.name, filepath)
+        mmap_mode = 'r' if self.mmap_output else None
+        if os.path.isfile(filepath):
+            # output persisted as a single file by older versions of steppy
+            return joblib.load(filepath, mmap_mode=mmap_mode)
+        index = _read_output_index(filepath)
+        return _PersistedOutput(filepath, index['keys'], index['filenames'], mmap_mode)
+
+    def _persist_output(self, output_data, filepath, fingerprint=None):
+        # One file per key, so that only one value has to be serialized at a time.
+        # Index is written last, output without it is not considered persisted.
+        if os.path.isdir(filepath):
+            # drops files of keys that the new output does not have
+            shutil.rmtree(filepath)
+        elif os.path.isfile(filepath):
+            os.remove(filepath)
+        os.makedirs(filepath)
+        index_filepath = os.path.join(filepath, _OUTPUT_INDEX)
+        keys = list(output_data.keys())
+        filenames = []
+        for position, key in enumerate(keys):
+            value = output_data[key]
+            # Arrays are saved in the .npy format, which is written without pickling and loaded
+            # by numpy directly. Everything else is pickled by joblib, uncompressed unless asked
+            # otherwise, so that arrays inside can still be memory-mapped when loaded.
+            if type(value) in (np.ndarray, np.memmap) and not value.dtype.hasobject:
+                filename = '{}.npy'.format(position)
+                np.save(os.path.join(filepath, filename), value, allow_pickle=False)
+            else:
+                filename = '{}.pkl.z'.format(position) if self.compress_output else '{}.pkl'.format(position)
+                joblib.dump(value, os.path.join(filepath, filename), compress=self.compress_output,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            filenames.append(filename)
+        with open(index_filepath, 'wb') as index_file:
+            pickle.dump({'keys': keys, 'filenames': filenames, 'fingerprint': fingerprint}, index_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
 
     def _adapt(self, step_inputs):
-        logger.info('Step {}, adapting inputs'.format(self.name))
+        logger.info('Step %s, adapting inputs', self.name)
         try:
             return self.adapter.adapt(step_inputs)
         except AdapterError as e:
@@ -641,36 +1167,88 @@ class Step:
             raise StepError(msg) from e
 
     def _unpack(self, step_inputs):
-        logger.info('Step {}, unpacking inputs'.format(self.name))
+        logger.info('Step %s, unpacking inputs', self.name)
+        if len(step_inputs) == 1:
+            # transformer gets inputs as **kwargs, so single data packet can be passed on without a copy
+            return next(iter(step_inputs.values()))
         unpacked_steps = {}
-        key_to_step_names = defaultdict(list)
-        for step_name, step_dict in step_inputs.items():
+        n_keys = 0
+        for step_dict in step_inputs.values():
             unpacked_steps.update(step_dict)
-            for key in step_dict.keys():
-                key_to_step_names[key].append(step_name)
-
-        repeated_keys = [(key, step_names) for key, step_names in key_to_step_names.items()
-                         if len(step_names) > 1]
-        if len(repeated_keys) == 0:
+            n_keys += len(step_dict)
+        if len(unpacked_steps) == n_keys:
             return unpacked_steps
-        else:
-            msg = "Could not unpack inputs. Following keys are present in multiple input steps:\n " \
-                  "\n".join(["  '{}' present in steps {}".format(key, step_names)
-                             for key, step_names in repeated_keys])
-            raise StepError(msg)
+        # some keys were overwritten, find them only now to report all of them
+        seen_keys, repeated = set(), set()
+        for step_dict in step_inputs.values():
+            for key in step_dict.keys():
+                if key in seen_keys:
+                    repeated.add(key)
+                else:
+                    seen_keys.add(key)
+
+        repeated_keys = [(key, [step_name for step_name, step_dict in step_inputs.items() if key in step_dict])
+                         for key in sorted(repeated)]
+        msg = "Could not unpack inputs. Following keys are present in multiple input steps:\n " \
+              "\n".join(["  '{}' present in steps {}".format(key, step_names)
+                         for key, step_names in repeated_keys])
+        raise StepError(msg)
 
     def _prepare_experiment_directories(self):
-        if not os.path.exists(os.path.join(self.experiment_directory, 'transformers')):
-            logger.info('initializing experiment directories under {}'.format(self.experiment_directory))
-            for dir_name in ['transformers', 'output']:
-                os.makedirs(os.path.join(self.experiment_directory, dir_name), exist_ok=True)
-
-    def _get_steps(self, all_steps):
-        self._check_name_uniqueness(all_steps=all_steps)
-        for input_step in self.input_steps:
-            all_steps = input_step._get_steps(all_steps)
-        all_steps[self.name] = self
-        return all_steps
+        if self.experiment_directory in _prepared_experiment_directories:
+            return
+        with _prepared_experiment_directories_lock:
+            if not os.path.exists(os.path.join(self.experiment_directory, 'transformers')):
+                logger.info('initializing experiment directories under %s', self.experiment_directory)
+                for dir_name in ['transformers', 'output']:
+                    os.makedirs(os.path.join(self.experiment_directory, dir_name), exist_ok=True)
+            _prepared_experiment_directories.add(self.experiment_directory)
+
+    def _is_upstream_of(self, steps):
+        visited, queue = set(), deque(steps)
+        while queue:
+            step = queue.popleft()
+            if step is self:
+                return True
+            if id(step) not in visited:
+                visited.add(id(step))
+                queue.extend(step.input_steps)
+        return False
+
+    def _get_steps(self):
+        upstream_steps, queue = {id(self): self}, deque([self])
+        while queue:
+            for input_step in queue.popleft().input_steps:
+                if id(input_step) not in upstream_steps:
+                    upstream_steps[id(input_step)] = input_step
+                    queue.append(input_step)
+
+        in_degree, consumers = {}, defaultdict(list)
+        for step_id, step in upstream_steps.items():
+            input_ids = dict.fromkeys(id(input_step) for input_step in step.input_steps)
+            if id(step._transformer_step) in upstream_steps:
+                # Step that uses transformer of another Step runs after it
+                input_ids[id(step._transformer_step)] = None
+            in_degree[step_id] = len(input_ids)
+            for input_id in input_ids:
+                consumers[input_id].append(step)
+
+        ready = deque(step for step_id, step in upstream_steps.items() if in_degree[step_id] == 0)
+        names, ordered_steps = set(), []
+        while ready:
+            step = ready.popleft()
+            step._check_name_uniqueness(names=names)
+            names.add(step.name)
+            ordered_steps.append(step)
+            for consumer in consumers[id(step)]:
+                in_degree[id(consumer)] -= 1
+                if in_degree[id(consumer)] == 0:
+                    ready.append(consumer)
+
+        if len(ordered_steps) != len(upstream_steps):
+            msg = 'Step {} error, upstream pipeline contains a cycle.'.format(self.name)
+            raise StepError(msg)
+        return ordered_steps
 
     def _format_step_name(self, name, transformer):
         self._validate_step_name(name=name)
@@ -685,33 +1263,23 @@ class Step:
             assert isinstance(name, str) or isinstance(name, float) or isinstance(name, int),\
                 'Step name must be str, float or int. Got {} instead.'.format(type(name))
 
-    def _check_name_uniqueness(self, all_steps):
-        if self.name in all_steps.keys():
-            logger.info('STEPPY WARNING: Step with name "{}", already exist. '
-                        'Make sure that all Steps have unique name.'.format(self.name))
+    def _check_name_uniqueness(self, names):
+        if self.name in names:
+            logger.info('STEPPY WARNING: Step with name "%s", already exist. '
+                        'Make sure that all Steps have unique name.', self.name)
 
     def _validate_upstream_names(self):
         try:
-            _ = self.all_upstream_steps.keys()
+            _ = self._upstream_plan.steps_by_name.keys()
         except ValueError as e:
             msg = 'Incorrect Step names'
             raise StepError(msg) from e
 
-    def _build_structure_dict(self, structure_dict):
-        for input_step in self.input_steps:
-            structure_dict = input_step._build_structure_dict(structure_dict)
-            structure_dict['edges'].add((input_step.name, self.name))
-        structure_dict['nodes'].add(self.name)
-        for input_data in self.input_data:
-            structure_dict['nodes'].add(input_data)
-            structure_dict['edges'].add((input_data, self.name))
-        return structure_dict
-
     def _set_mode(self, mode):
         self.clean_cache_upstream()
-        for name, step_obj in self.all_upstream_steps.items():
+        for step_obj in self._upstream_plan.steps:
             step_obj._mode = mode
-        logger.info('Step {}, applied "{}" mode to all upstream Steps, including this Step'.format(self.name, mode))
+        logger.info('Step %s, applied "%s" mode to all upstream Steps, including this Step', self.name, mode)
 
     def _repr_html_(self):
         return display_upstream_structure(self.upstream_structure)
@@ -719,6 +1287,150 @@ class Step:
     def __str__(self):
         return pprint.pformat(self.upstream_structure)
 
+    def __getstate__(self):
+        # Defined explicitly, so that Steps can be pickled with protocols 0 and 1 in all Python versions.
+        # Cached upstream pipeline structure is left out, it is built again when needed.
+        slots = {name: getattr(self, name) for name in _get_slots(type(self))
+                 if name not in ('__dict__', '__weakref__', '_upstream_plan_cache') and hasattr(self, name)}
+        # only subclasses that do not declare __slots__ have __dict__
+        return dict(getattr(self, '__dict__', {})), slots
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Step pickled before Step declared __slots__, its state is its __dict__,
+            # with attributes like name or input_steps that are now set through properties
+            attributes, slots = {}, dict(_PICKLED_STEP_DEFAULTS, **state)
+        else:
+            attributes, slots = state
+        if attributes:
+            self.__dict__.update(attributes)
+        self._upstream_plan_cache = None
+        for name, value in slots.items():
+            setattr(self, name, value)
+
+    # method names, so that subclasses can override the operations
+    _operations = {'fit_transform': '_fit_transform_operation',
+                   'transform': '_transform_operation'}
+
+
+class _PersistedOutput(Mapping):
+    """Step output persisted to a directory, values are loaded on first access."""
+
+    def __init__(self, dirpath, keys, filenames, mmap_mode=None):
+        self.dirpath = dirpath
+        self.mmap_mode = mmap_mode
+        self._filenames = dict(zip(keys, filenames))
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            filename = self._filenames[key]
+            filepath = os.path.join(self.dirpath, filename)
+            if filename.endswith('.npy'):
+                value = np.load(filepath, mmap_mode=self.mmap_mode, allow_pickle=False)
+            elif filename.endswith('.z'):
+                # compressed files cannot be memory-mapped
+                value = joblib.load(filepath)
+            else:
+                value = joblib.load(filepath, mmap_mode=self.mmap_mode)
+            self._values[key] = value
+            return value
+
+    def __iter__(self):
+        return iter(self._filenames)
+
+    def __len__(self):
+        return len(self._filenames)
+
+    def __repr__(self):
+        return '{}({!r}, keys={})'.format(self.__class__.__name__, self.dirpath, list(self._filenames))
+
+
+_StepPaths = namedtuple('_StepPaths', ['key', 'transformers_dirpath', 'transformers_filepath',
+                                       'output_dirpath', 'output_filepath'])
+
+
+class _RunOutputs:
+    """Outputs of Steps during one run.
+
+    Output is dropped as soon as all Steps that use it collected it, so that memory
+    of intermediate outputs is released while the pipeline is still running.
+    """
+
+    def __init__(self, steps_to_run, n_steps):
+        self._outputs = [None] * n_steps
+        self._n_consumers = defaultdict(int)
+        for _, input_recipe in steps_to_run:
+            for _, j in input_recipe or ():
+                self._n_consumers[j] += 1
+        self._lock = threading.Lock()
+
+    def __getitem__(self, i):
+        return self._outputs[i]
+
+    def __setitem__(self, i, output):
+        self._outputs[i] = output
+
+    def collect(self, input_recipe):
+        if input_recipe is None:
+            return None
+        step_inputs = {name: self._outputs[j] for name, j in input_recipe}
+        with self._lock:
+            for _, j in input_recipe:
+                self._n_consumers[j] -= 1
+                if self._n_consumers[j] == 0:
+                    self._outputs[j] = None
+        return step_inputs
+
+
+class _OutputWriter:
+    """Persists Step outputs in a background thread, one at a time, in the order of submission."""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+
+    def submit(self, persist, *args):
+        self._futures.append(self._executor.submit(persist, *args))
+
+    def wait(self):
+        # raises the first error that occurred while writing
+        for future in self._futures:
+            future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class _RunContext:
+    """State of a single pipeline run, passed to all Steps taking part in it.
+
+    ``fingerprints`` maps Steps to fingerprints of their outputs, see ``Step._get_fingerprints``.
+    """
+    __slots__ = ('fingerprints', 'output_writer')
+
+    def __init__(self):
+        self.fingerprints = {}
+        self.output_writer = None
+
+
+class _UpstreamPlan:
+    """Upstream Steps in topological order, with the Step calling them always last.
+
+    ``inputs[i]`` holds ``(name, position)`` of every input Step of ``steps[i]``.
+    ``structure`` is built on first access to ``upstream_structure``.
+    """
+    __slots__ = ('version', 'steps', 'inputs', 'steps_by_name', 'structure')
+
+    def __init__(self, version, steps, inputs):
+        self.version = version
+        self.steps = steps
+        self.inputs = inputs
+        self.steps_by_name = {step.name: step for step in steps}
+        self.structure = None
+
 
 class BaseTransformer:
     """Abstraction on ``fit`` and ``transform`` execution.
@@ -803,12 +1515,13 @@ class BaseTransformer:
         """Saves the trainable parameters of the transformer
 
         Specific implementation of model parameter persistence should be implemented here.
-        In case of transformer that do not learn any parameters one can leave this method as is.
+        In case of transformer that do not learn any parameters one can leave this method as is,
+        it creates an empty file that only marks the transformer as persisted.
 
         Args:
             filepath (str): filepath where the transformer parameters should be persisted
         """
-        joblib.dump('hello-steppy', filepath)
+        open(filepath, 'wb').close()
 
 
 class StepError(Exception):
@@ -817,24 +1530,233 @@ class StepError(Exception):
 
 def make_transformer(func):
     class StaticTransformer(BaseTransformer):
-        def fit(self):
-            logger.info('StaticTransformer "{}" is not fittable.'
-                        'By running "fit_transform()", you simply "transform()".'.format(self.__class__.__name__))
+        def fit(self, *args, **kwargs):
+            logger.info('StaticTransformer "%s" is not fittable.'
+                        'By running "fit_transform()", you simply "transform()".', self.__class__.__name__)
             return self
 
         def transform(self, *args, **kwargs):
             return func(*args, **kwargs)
 
         def persist(self, filepath):
-            logger.info('StaticTransformer "{}" is not persistable.'.format(self.__class__.__name__))
+            logger.info('StaticTransformer "%s" is not persistable.', self.__class__.__name__)
 
     _transformer = StaticTransformer()
     _transformer.__class__.__name__ = func.__name__
     return _transformer
 
 
+def memoize_transform(transformer_class=None, maxsize=2):
+    """Class decorator that memoizes outputs of the transformer's ``transform`` method.
+
+    When ``transform`` is called again with the very same inputs, the remembered output is
+    returned instead of being computed. Arrays, data frames and other objects are compared by
+    identity, which is cheap, so inputs must not be modified in place between calls.
+    Scalars and strings are compared by value. Memoized outputs are forgotten whenever
+    ``fit`` or ``load`` is called, and when one of their inputs is deleted.
+
+    Warning:
+        Remembered outputs stay in memory until they are forgotten, so up to ``maxsize``
+        outputs per transformer instance are kept alive on top of what the pipeline holds.
+        Inputs that cannot be weakly referenced, like dicts and lists, are kept alive with them.
+        The remembered output is returned as is, not copied, so all callers get the same
+        object, and modifying it in place changes what later calls return.
+
+    Example:
+        .. code-block:: python
+
+            @memoize_transform(maxsize=4)
+            class FeatureExtractor(BaseTransformer):
+                def transform(self, X):
+                    return {'features': extract(X)}
+
+    Args:
+        transformer_class (type): class that inherits from BaseTransformer.
+        maxsize (int): number of outputs remembered per transformer instance.
+            Least recently used outputs are forgotten first. Default ``2``.
+
+    Returns:
+        type: decorated class
+    """
+    if transformer_class is None:
+        return functools.partial(memoize_transform, maxsize=maxsize)
+
+    memoized = weakref.WeakKeyDictionary()
+    transform = transformer_class.transform
+
+    @functools.wraps(transform)
+    def memoized_transform(self, *args, **kwargs):
+        outputs = memoized.setdefault(self, OrderedDict())
+        key = (tuple(_memoization_key(arg) for arg in args),
+               tuple((name, _memoization_key(value)) for name, value in sorted(kwargs.items())))
+        if key in outputs:
+            outputs.move_to_end(key)
+            return outputs[key][0]
+        output = transform(self, *args, **kwargs)
+
+        def forget(_):
+            outputs.pop(key, None)
+
+        # ids of inputs must not be reused by other objects while the output is remembered,
+        # so the output is forgotten when an input is deleted, or the input is kept alive
+        # if it cannot be weakly referenced
+        outputs[key] = (output, [_input_reference(value, forget) for value in args + tuple(kwargs.values())])
+        if len(outputs) > maxsize:
+            outputs.popitem(last=False)
+        return output
+
+    def forgetting_outputs(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            memoized.pop(self, None)
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    transformer_class.transform = memoized_transform
+    transformer_class.fit = forgetting_outputs(transformer_class.fit)
+    transformer_class.load = forgetting_outputs(transformer_class.load)
+    return transformer_class
+
+
+def _memoization_key(value):
+    if isinstance(value, (str, bytes, int, float, type(None))):
+        return type(value), value
+    return id(value)
+
+
+def _input_reference(value, callback):
+    if isinstance(value, (str, bytes, int, float, type(None))):
+        return None
+    try:
+        return weakref.ref(value, callback)
+    except TypeError:
+        return value
+
+
+def _run_operation(step, step_inputs, mode):
+    step_output_data = getattr(step, step._operations[mode])(step_inputs)
+    return step_output_data, step.transformer
+
+
+def _fingerprint_data_part(data, input_data_part):
+    if not isinstance(data, dict) or input_data_part not in data:
+        return None
+    try:
+        return _fingerprint_data_packet(data[input_data_part])
+    except _UNHASHABLE_ERRORS:
+        return None
+
+
+def _fingerprint_data_packet(data_packet):
+    if isinstance(data_packet, dict):
+        return joblib.hash({key: cheap_hash(value) for key, value in data_packet.items()})
+    return cheap_hash(data_packet)
+
+
+def _get_slots(cls):
+    # slots declared by the class and all its base classes
+    slots = []
+    for base in cls.__mro__:
+        base_slots = base.__dict__.get('__slots__', ())
+        slots.extend((base_slots,) if isinstance(base_slots, str) else base_slots)
+    return slots
+
+
+def _is_settable_property(cls, name):
+    attribute = getattr(cls, name, None)
+    return isinstance(attribute, property) and attribute.fset is not None
+
+
+def _transformer_source(filepath):
+    # hard-linked transformer files of different Steps are the same file, loaded once
+    stat = os.stat(filepath)
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+
+def _get_transformer_source(transformer):
+    try:
+        return _transformer_sources.get(transformer)
+    except TypeError:
+        # transformer that cannot be weakly referenced or hashed is always loaded
+        return None
+
+
+def _set_transformer_source(transformer, filepath):
+    try:
+        _transformer_sources[transformer] = _transformer_source(filepath)
+    except TypeError:
+        pass
+
+
+def _copy_file(src, dst):
+    # copy_file_range copies inside the kernel, and clones the file on filesystems that support it
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                remaining = os.fstat(src_file.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src_file.fileno(), dst_file.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def _set_read_only(output_data, step_inputs):
+    # arrays passed through from inputs, also from lists or dicts made by an adapter, are left writable
+    input_ids, values = set(), list(step_inputs.values())
+    while values:
+        value = values.pop()
+        input_ids.add(id(value))
+        if isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif isinstance(value, dict):
+            values.extend(value.values())
+    for value in output_data.values():
+        if isinstance(value, np.ndarray) and id(value) not in input_ids:
+            value.setflags(write=False)
+
+
+def _read_output_index(dirpath):
+    with open(os.path.join(dirpath, _OUTPUT_INDEX), 'rb') as index_file:
+        return pickle.load(index_file)
+
+
+def _prefetch(filepaths):
+    # only a hint for the OS, files that cannot be read are left to the Step that loads them
+    for filepath in filepaths:
+        try:
+            if os.path.isdir(filepath):
+                shard_filepaths = [entry.path for entry in os.scandir(filepath)]
+            else:
+                shard_filepaths = [filepath]
+            for shard_filepath in shard_filepaths:
+                fd = os.open(shard_filepath, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+        except OSError:
+            continue
+
+
+def _get_process_pool(max_workers):
+    # Imported here, so that loky is loaded only when worker processes are used.
+    # The executor is reused between calls and it is restarted if its workers die.
+    from joblib.externals.loky import get_reusable_executor
+    return get_reusable_executor(max_workers=max_workers)
+
+
 class IdentityOperation(BaseTransformer):
-    """Transformer that performs identity operation, f(x)=x."""
+    """Transformer that performs identity operation, f(x)=x.
+
+    Step recognizes this transformer and passes its inputs through without calling it,
+    so it never needs to be fitted or loaded. Subclasses are called like any other transformer.
+    """
 
     def transform(self, **kwargs):
         return kwargs
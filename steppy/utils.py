@@ -1,8 +1,12 @@
+import functools
 import logging
 import sys
 
-import pydot_ng as pydot
-from IPython.display import Image, display
+import joblib
+import numpy as np
+
+# number of elements sampled from large arrays and rows sampled from large data frames by cheap_hash
+_SAMPLE_SIZE = 1024
 
 
 def initialize_logger():
@@ -68,6 +72,38 @@ def get_logger():
     return logging.getLogger('steppy')
 
 
+def cheap_hash(obj, strict=False):
+    """Hash object in time that does not grow with the size of large arrays and data frames.
+
+    Numpy arrays with more than 1024 elements are hashed by their shape, dtype and 1024 evenly
+    spaced elements. Data frames with more than 1024 rows are hashed by their shape, columns,
+    dtypes, first and last index labels and 1024 evenly spaced rows. Everything else is hashed
+    with ``joblib.hash``.
+
+    Note:
+        Two arrays that differ only outside of the sampled elements get the same hash.
+        Use ``strict=True`` when that is not acceptable.
+
+    Args:
+        obj (obj): object to hash.
+        strict (bool): If True, hash the entire content of ``obj`` with ``joblib.hash``.
+
+    Returns:
+        str: hash of the object.
+    """
+    if strict:
+        return joblib.hash(obj)
+    if isinstance(obj, np.ndarray) and obj.size > _SAMPLE_SIZE:
+        positions = np.linspace(0, obj.size - 1, num=_SAMPLE_SIZE, dtype=np.int64)
+        return joblib.hash((obj.shape, obj.dtype.str, obj.flat[positions]))
+    if hasattr(obj, 'iloc') and hasattr(obj, 'index') and len(obj) > _SAMPLE_SIZE:
+        # data frame or series, recognized without importing pandas
+        positions = np.linspace(0, len(obj) - 1, num=_SAMPLE_SIZE, dtype=np.int64)
+        return joblib.hash((type(obj).__name__, obj.shape, getattr(obj, 'columns', None), str(obj.dtypes),
+                            obj.index[0], obj.index[-1], obj.iloc[positions]))
+    return joblib.hash(obj)
+
+
 def display_upstream_structure(structure_dict):
     """Displays pipeline structure in the jupyter notebook.
 
@@ -75,8 +111,10 @@ def display_upstream_structure(structure_dict):
         structure_dict (dict): dict returned by
             :func:`~steppy.base.Step.upstream_structure`.
     """
-    graph = _create_graph(structure_dict)
-    plt = Image(graph.create_png())
+    # imported here, so that importing steppy does not pay for IPython, which is only needed in notebooks
+    from IPython.display import Image, display
+
+    plt = Image(_render_png(structure_dict))
     display(plt)
 
 
@@ -88,8 +126,26 @@ def persist_as_png(structure_dict, filepath):
             :func:`~steppy.base.Step.upstream_structure`
         filepath (str): filepath to which the png with pipeline visualization should be persisted
     """
-    graph = _create_graph(structure_dict)
-    graph.write(filepath, format='png')
+    with open(filepath, 'wb') as png_file:
+        png_file.write(_render_png(structure_dict))
+
+
+def _render_png(structure_dict):
+    """Renders pipeline structure dict as png, rendering is reused for the same structure.
+
+    Args:
+        structure_dict (dict): dict returned by step.upstream_structure
+
+    Returns:
+        bytes: png image of the upstream pipeline structure.
+    """
+    return _render_png_cached(frozenset(structure_dict['nodes']), frozenset(structure_dict['edges']))
+
+
+@functools.lru_cache(maxsize=32)
+def _render_png_cached(nodes, edges):
+    graph = _create_graph({'nodes': nodes, 'edges': edges})
+    return graph.create_png()
 
 
 def _create_graph(structure_dict):
@@ -101,9 +157,11 @@ def _create_graph(structure_dict):
     Returns:
         graph (pydot.Dot): object representing upstream pipeline structure (with regard to the current Step).
     """
+    import pydot_ng as pydot
+
     graph = pydot.Dot()
-    for node in structure_dict['nodes']:
+    for node in sorted(structure_dict['nodes'], key=str):
         graph.add_node(pydot.Node(node))
-    for node1, node2 in structure_dict['edges']:
+    for node1, node2 in sorted(structure_dict['edges'], key=str):
         graph.add_edge(pydot.Edge(node1, node2))
     return graph
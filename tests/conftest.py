@@ -1,6 +1,25 @@
 import steppy.base  # To make sure logger is initialized before running prepare_steps_logger
 
-from .steppy_test_utils import prepare_steps_logger
+import pytest
+
+from .steppy_test_utils import prepare_steps_logger, FEATURES, LABELS, EXTRA_FEATURES, IMAGES, IMAGE_LABELS
+
+
+@pytest.fixture(scope='session')
+def data():
+    return {
+        'input_1': {
+            'features': FEATURES,
+            'labels': LABELS
+        },
+        'input_2': {
+            'extra_features': EXTRA_FEATURES
+        },
+        'input_3': {
+            'images': IMAGES,
+            'labels': IMAGE_LABELS
+        }
+    }
 
 
 def pytest_sessionstart(session):
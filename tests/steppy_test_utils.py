@@ -3,8 +3,32 @@ import os
 
 from pathlib import Path
 
+import numpy as np
+
 LOGS_PATH = 'steps_tests.log'
 
+FEATURES = np.array([
+    [1, 6],
+    [2, 5],
+    [3, 4]
+], dtype=np.int32)
+LABELS = np.array([2, 5, 3], dtype=np.int32)
+EXTRA_FEATURES = np.array([
+    [5, 7, 3],
+    [67, 4, 5],
+    [6, 13, 14]
+], dtype=np.int32)
+IMAGES = np.array([
+    [[0, 255], [255, 0]],
+    [[255, 0], [0, 255]],
+    [[255, 255], [0, 0]],
+], dtype=np.uint8)
+IMAGE_LABELS = np.array([1, 1, 0], dtype=np.int8)
+
+# arrays are shared by all tests, so they must not be modified
+for array in (FEATURES, LABELS, EXTRA_FEATURES, IMAGES, IMAGE_LABELS):
+    array.setflags(write=False)
+
 
 def remove_logs():
     if Path(LOGS_PATH).exists():
@@ -1,36 +1,6 @@
-import numpy as np
 import pytest
 
-from steppy.adapter import Adapter, E
-
-
-@pytest.fixture
-def data():
-    return {
-        'input_1': {
-            'features': np.array([
-                [1, 6],
-                [2, 5],
-                [3, 4]
-            ]),
-            'labels': np.array([2, 5, 3])
-        },
-        'input_2': {
-            'extra_features': np.array([
-                [5, 7, 3],
-                [67, 4, 5],
-                [6, 13, 14]
-            ])
-        },
-        'input_3': {
-            'images': np.array([
-                [[0, 255], [255, 0]],
-                [[255, 0], [0, 255]],
-                [[255, 255], [0, 0]],
-            ]),
-            'labels': np.array([1, 1, 0])
-        }
-    }
+from steppy.adapter import Adapter, AdapterError, E
 
 
 def test_adapter_creates_defined_keys(data):
@@ -43,6 +13,18 @@ def test_adapter_creates_defined_keys(data):
     assert {'X', 'Y'} == set(res.keys())
 
 
+def test_adapter_keeps_order_of_recipes(data):
+    adapter = Adapter({
+        'X': [E('input_1', 'features')],
+        'Y': E('input_1', 'labels'),
+        'Z': 0,
+        'W': E('input_2', 'extra_features')
+    })
+    res = adapter.adapt(data)
+
+    assert list(res.keys()) == ['X', 'Y', 'Z', 'W']
+
+
 def test_recipe_with_single_item(data):
     adapter = Adapter({
         'X': E('input_1', 'labels'),
@@ -50,8 +32,8 @@ def test_recipe_with_single_item(data):
     })
     res = adapter.adapt(data)
 
-    assert np.array_equal(res['X'], data['input_1']['labels'])
-    assert np.array_equal(res['Y'], data['input_3']['labels'])
+    assert res['X'] is data['input_1']['labels']
+    assert res['Y'] is data['input_3']['labels']
 
 
 def test_recipe_with_list(data):
@@ -67,9 +49,9 @@ def test_recipe_with_list(data):
         assert len(res[key]) == i
 
     assert res['X'] == []
-    assert np.array_equal(res['Y'][0], data['input_1']['features'])
-    assert np.array_equal(res['Z'][0], data['input_1']['features'])
-    assert np.array_equal(res['Z'][1], data['input_2']['extra_features'])
+    assert res['Y'][0] is data['input_1']['features']
+    assert res['Z'][0] is data['input_1']['features']
+    assert res['Z'][1] is data['input_2']['extra_features']
 
 
 def test_recipe_with_tuple(data):
@@ -85,9 +67,9 @@ def test_recipe_with_tuple(data):
         assert len(res[key]) == i
 
     assert res['X'] == ()
-    assert np.array_equal(res['Y'][0], data['input_1']['features'])
-    assert np.array_equal(res['Z'][0], data['input_1']['features'])
-    assert np.array_equal(res['Z'][1], data['input_2']['extra_features'])
+    assert res['Y'][0] is data['input_1']['features']
+    assert res['Z'][0] is data['input_1']['features']
+    assert res['Z'][1] is data['input_2']['extra_features']
 
 
 def test_recipe_with_dictionary(data):
@@ -104,9 +86,9 @@ def test_recipe_with_dictionary(data):
         assert len(res[key]) == i
 
     assert res['X'] == {}
-    assert np.array_equal(res['Y']['a'], data['input_1']['features'])
-    assert np.array_equal(res['Z']['a'], data['input_1']['features'])
-    assert np.array_equal(res['Z']['b'], data['input_2']['extra_features'])
+    assert res['Y']['a'] is data['input_1']['features']
+    assert res['Z']['a'] is data['input_1']['features']
+    assert res['Z']['b'] is data['input_2']['extra_features']
 
 
 def test_recipe_with_constants(data):
@@ -137,3 +119,55 @@ def test_nested_recipes(data):
 
     assert res['X'] == [{'a': [data['input_1']['features']]}]
     assert res['Y'] == {'a': [{'b': data['input_2']['extra_features']}]}
+
+
+def test_recipe_with_missing_input_or_key(data):
+    adapter = Adapter({'X': E('input_4', 'features')})
+    with pytest.raises(AdapterError):
+        adapter.adapt(data)
+
+    adapter = Adapter({'X': [E('input_1', 'images')]})
+    with pytest.raises(AdapterError):
+        adapter.adapt(data)
+
+
+def test_malformed_recipes_are_rejected_at_construction():
+    with pytest.raises(AdapterError):
+        Adapter([('X', E('input_1', 'features'))])
+
+    with pytest.raises(AdapterError):
+        Adapter({0: E('input_1', 'features')})
+
+    with pytest.raises(AdapterError):
+        Adapter({'X': E(['input_1'], 'features')})
+
+    with pytest.raises(AdapterError):
+        Adapter({'X': [E(['input_1'], 'features')]})
+
+
+def test_recipe_with_non_str_input_name(data):
+    adapter = Adapter({'X': E(1, 'features'), 'Y': [E(1, 'features')]})
+    res = adapter.adapt({1: data['input_1']})
+
+    assert res['X'] is data['input_1']['features']
+    assert res['Y'] == [data['input_1']['features']]
+
+
+def test_reassigned_recipes_are_used(data):
+    adapter = Adapter({'X': E('input_1', 'features')})
+    adapter.adapting_recipes = {'Y': E('input_3', 'images')}
+    res = adapter.adapt(data)
+
+    assert set(res.keys()) == {'Y'}
+    assert res['Y'] is data['input_3']['images']
+
+
+def test_overridden_compilers_are_used(data):
+    class ListsAsTuplesAdapter(Adapter):
+        def _compile_list(self, lst):
+            return self._compile_tuple(tuple(lst))
+
+    adapter = ListsAsTuplesAdapter({'X': [E('input_1', 'features'), E('input_1', 'labels')]})
+    res = adapter.adapt(data)
+
+    assert res['X'] == (data['input_1']['features'], data['input_1']['labels'])
@@ -1,37 +1,32 @@
+import copyreg
+import os
+import pickle
+import threading
+import weakref
+
+import joblib
 import numpy as np
 import pytest
 
-from steppy.base import Step, StepError, make_transformer, IdentityOperation
+from steppy.base import Step, StepError, BaseTransformer, make_transformer, memoize_transform, IdentityOperation
+from steppy.base import _RunOutputs, _copy_file
 from steppy.adapter import Adapter, E
+from .steppy_test_utils import FEATURES, LABELS, EXTRA_FEATURES
+
+# IdentityOperation is stateless, so all Steps can share one
+_IDENTITY = IdentityOperation()
 
 
 @pytest.fixture
-def data():
-    return {
-        'input_1': {
-            'features': np.array([
-                [1, 6],
-                [2, 5],
-                [3, 4]
-            ]),
-            'labels': np.array([2, 5, 3])
-        },
-        'input_2': {
-            'extra_features': np.array([
-                [5, 7, 3],
-                [67, 4, 5],
-                [6, 13, 14]
-            ])
-        },
-        'input_3': {
-            'images': np.array([
-                [[0, 255], [255, 0]],
-                [[255, 0], [0, 255]],
-                [[255, 255], [0, 0]],
-            ]),
-            'labels': np.array([1, 1, 0])
-        }
-    }
+def experiment_directory(tmpdir):
+    return str(tmpdir)
+
+
+def _assert_outputs_equal(output, expected):
+    # dict == compares arrays with ==, which is ambiguous unless they happen to be the same objects
+    assert set(output.keys()) == set(expected.keys())
+    for key, value in expected.items():
+        assert np.array_equal(output[key], value), key
 
 
 @pytest.mark.parametrize("mode", [0, 1])
@@ -45,45 +40,53 @@ def test_make_transformer(mode):
     assert res == (10 if mode == 0 else 4)
 
 
-def test_inputs_without_conflicting_names_do_not_require_adapter(data):
-    step = Step(
-        name='test_inputs_without_conflicting_names_do_not_require_adapter_1',
-        transformer=IdentityOperation(),
-        input_data=['input_1']
-    )
-    output = step.fit_transform(data)
-    assert output == data['input_1']
+def test_make_transformer_fit_transform():
+    def fun(x, y):
+        return {'sum': x + y}
+    tr = make_transformer(fun)
+
+    assert tr.fit_transform(x=7, y=3) == {'sum': 10}
 
+
+@pytest.mark.parametrize("input_data, expected", [
+    (['input_1'], {'features': FEATURES, 'labels': LABELS}),
+    (['input_1', 'input_2'], {'features': FEATURES, 'labels': LABELS, 'extra_features': EXTRA_FEATURES}),
+])
+def test_inputs_without_conflicting_names_do_not_require_adapter(data, experiment_directory, input_data, expected):
     step = Step(
-        name='test_inputs_without_conflicting_names_do_not_require_adapter_2',
-        transformer=IdentityOperation(),
-        input_data=['input_1', 'input_2']
+        name='test_inputs_without_conflicting_names_do_not_require_adapter',
+        transformer=_IDENTITY,
+        input_data=input_data,
+        experiment_directory=experiment_directory
     )
     output = step.fit_transform(data)
-    assert output == {**data['input_1'], **data['input_2']}
+    _assert_outputs_equal(output, expected)
 
 
-def test_inputs_with_conflicting_names_require_adapter(data):
+def test_inputs_with_conflicting_names_require_adapter(data, experiment_directory):
     step = Step(
         name='test_inputs_with_conflicting_names_require_adapter',
-        transformer=IdentityOperation(),
-        input_data=['input_1', 'input_3']
+        transformer=_IDENTITY,
+        input_data=['input_1', 'input_3'],
+        experiment_directory=experiment_directory
     )
-    with pytest.raises(StepError):
+    with pytest.raises(StepError) as excinfo:
         step.fit_transform(data)
+    assert "'labels' present in steps ['input_1', 'input_3']" in str(excinfo.value)
 
 
-def test_step_with_adapted_inputs(data):
+def test_step_with_adapted_inputs(data, experiment_directory):
     step = Step(
         name='test_step_wit_adapted_inputs',
-        transformer=IdentityOperation(),
+        transformer=_IDENTITY,
         input_data=['input_1', 'input_3'],
         adapter=Adapter({
             'img': E('input_3', 'images'),
             'fea': E('input_1', 'features'),
             'l1': E('input_3', 'labels'),
             'l2': E('input_1', 'labels'),
-        })
+        }),
+        experiment_directory=experiment_directory
     )
     output = step.fit_transform(data)
     expected = {
@@ -92,4 +95,1118 @@ def test_step_with_adapted_inputs(data):
         'l1': data['input_3']['labels'],
         'l2': data['input_1']['labels'],
     }
-    assert output == expected
+    _assert_outputs_equal(output, expected)
+
+
+def test_rewiring_input_steps_updates_upstream_steps(data, experiment_directory):
+    step_1 = Step(
+        name='test_rewiring_input_steps_updates_upstream_steps_1',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step_2 = Step(
+        name='test_rewiring_input_steps_updates_upstream_steps_2',
+        transformer=_IDENTITY,
+        input_data=['input_2'],
+        experiment_directory=experiment_directory
+    )
+    step_3 = Step(
+        name='test_rewiring_input_steps_updates_upstream_steps_3',
+        transformer=_IDENTITY,
+        input_steps=[step_1],
+        experiment_directory=experiment_directory
+    )
+    assert list(step_3.all_upstream_steps.keys()) == [step_1.name, step_3.name]
+
+    step_3.input_steps = [step_1, step_2]
+    assert list(step_3.all_upstream_steps.keys()) == [step_1.name, step_2.name, step_3.name]
+
+
+def test_renaming_step_updates_upstream_steps(data, experiment_directory):
+    step_1 = Step(
+        name='test_renaming_step_updates_upstream_steps_1',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step_2 = Step(
+        name='test_renaming_step_updates_upstream_steps_2',
+        transformer=_IDENTITY,
+        input_steps=[step_1],
+        experiment_directory=experiment_directory
+    )
+    assert step_2.get_step_by_name(step_1.name) is step_1
+
+    step_1.name = 'test_renaming_step_updates_upstream_steps_renamed'
+    assert list(step_2.all_upstream_steps.keys()) == [step_1.name, step_2.name]
+    assert step_2.get_step_by_name(step_1.name) is step_1
+    assert step_1.name in step_2.upstream_structure['nodes']
+
+
+def test_step_subclass_overrides_operations(data, experiment_directory):
+    class CountingStep(Step):
+        calls = []
+
+        def _fit_transform_operation(self, step_inputs):
+            self.calls.append('fit_transform')
+            return super()._fit_transform_operation(step_inputs)
+
+        def _transform_operation(self, step_inputs):
+            self.calls.append('transform')
+            return super()._transform_operation(step_inputs)
+
+    step = CountingStep(
+        name='test_step_subclass_overrides_operations',
+        transformer=make_transformer(lambda features, labels: {'features': features}),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        is_fittable=False
+    )
+    step.fit_transform(data)
+    step.transform(data)
+
+    assert CountingStep.calls == ['fit_transform', 'transform']
+
+
+def test_set_parameters_upstream(data, experiment_directory):
+    step_1 = Step(
+        name='test_set_parameters_upstream_1',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step_2 = Step(
+        name='test_set_parameters_upstream_2',
+        transformer=_IDENTITY,
+        input_steps=[step_1],
+        experiment_directory=experiment_directory
+    )
+    step_2.set_parameters_upstream({'force_fitting': False, 'cache_output': True, 'input_data': ['input_2'],
+                                    'upstream_structure': None, 'unknown': 1, '_input_steps': [],
+                                    '_upstream_plan_cache': None, '__weakref__': None})
+
+    for step in (step_1, step_2):
+        assert not step.force_fitting
+        assert step.cache_output
+        assert step.input_data == ['input_2']
+        assert step.upstream_structure is not None
+        assert not hasattr(step, 'unknown')
+    assert step_2.input_steps == [step_1]
+
+
+def test_overridden_methods_of_upstream_steps_are_called(data, experiment_directory):
+    calls = []
+
+    class RecordingStep(Step):
+        def fit_transform(self, data):
+            calls.append(('fit_transform', self.name))
+            return super().fit_transform(data)
+
+        def transform(self, data):
+            calls.append(('transform', self.name))
+            return super().transform(data)
+
+    step_1 = RecordingStep(
+        name='test_overridden_methods_of_upstream_steps_are_called_1',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step_2 = Step(
+        name='test_overridden_methods_of_upstream_steps_are_called_2',
+        transformer=_IDENTITY,
+        input_steps=[step_1],
+        experiment_directory=experiment_directory
+    )
+    _assert_outputs_equal(step_2.fit_transform(data), data['input_1'])
+    _assert_outputs_equal(step_2.transform(data), data['input_1'])
+
+    assert calls == [('fit_transform', step_1.name), ('transform', step_1.name)]
+
+
+def test_set_parameters_upstream_sets_slots_of_subclasses(data, experiment_directory):
+    class SlottedStep(Step):
+        __slots__ = ('batch_size',)
+
+    step = SlottedStep(
+        name='test_set_parameters_upstream_sets_slots_of_subclasses',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step.set_parameters_upstream({'batch_size': 32})
+
+    assert step.batch_size == 32
+
+
+@pytest.mark.parametrize("protocol", range(pickle.HIGHEST_PROTOCOL + 1))
+def test_step_is_pickled_with_its_attributes(data, experiment_directory, protocol):
+    step_1 = Step(
+        name='test_step_is_pickled_with_its_attributes_1',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step_2 = Step(
+        name='test_step_is_pickled_with_its_attributes_2',
+        transformer=_IDENTITY,
+        input_steps=[step_1],
+        experiment_directory=experiment_directory,
+        cache_output=True
+    )
+    step_2.fit_transform(data)
+
+    unpickled_step = pickle.loads(pickle.dumps(step_2, protocol=protocol))
+
+    assert unpickled_step.name == step_2.name
+    assert unpickled_step.output_is_cached
+    assert list(unpickled_step.all_upstream_steps) == [step_1.name, step_2.name]
+    _assert_outputs_equal(unpickled_step.transform(data), step_2.transform(data))
+
+
+def test_step_pickled_with_its_dict_is_unpickled(data, experiment_directory):
+    class PickledStep:
+        # pickles as Steps did before Step declared __slots__
+        def __init__(self, state):
+            self.state = state
+
+        def __reduce__(self):
+            return copyreg._reconstructor, (Step, object, None), self.state
+
+    state = {
+        'name': 'test_step_pickled_with_its_dict_is_unpickled',
+        'transformer': _IDENTITY,
+        'output_directory': None,
+        'input_steps': [],
+        'input_data': ['input_1'],
+        'adapter': None,
+        'is_fittable': True,
+        'cache_output': False,
+        'persist_output': False,
+        'load_persisted_output': False,
+        'force_fitting': True,
+        'output': None,
+        'experiment_directory': experiment_directory,
+        '_mode': 'train'
+    }
+
+    step = pickle.loads(pickle.dumps(PickledStep(state)))
+
+    assert isinstance(step, Step)
+    assert step.name == state['name']
+    assert step.n_jobs == 1
+    _assert_outputs_equal(step.fit_transform(data), data['input_1'])
+
+
+def test_upstream_structure_is_rebuilt_after_invalidation(experiment_directory):
+    step = Step(
+        name='test_upstream_structure_is_rebuilt_after_invalidation',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    assert step.upstream_structure['nodes'] == {'input_1', step.name}
+
+    step.input_data.append('input_2')
+    step.invalidate_upstream_structure()
+    assert step.upstream_structure['nodes'] == {'input_1', 'input_2', step.name}
+
+
+def test_shared_upstream_step_is_collected_once(caplog, experiment_directory):
+    root = Step(
+        name='test_shared_upstream_step_is_collected_once_root',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    left = Step(
+        name='test_shared_upstream_step_is_collected_once_left',
+        transformer=_IDENTITY,
+        input_steps=[root],
+        experiment_directory=experiment_directory
+    )
+    right = Step(
+        name='test_shared_upstream_step_is_collected_once_right',
+        transformer=_IDENTITY,
+        input_steps=[root],
+        experiment_directory=experiment_directory
+    )
+    join = Step(
+        name='test_shared_upstream_step_is_collected_once_join',
+        transformer=_IDENTITY,
+        input_steps=[left, right],
+        experiment_directory=experiment_directory
+    )
+    assert list(join.all_upstream_steps.keys()) == [root.name, left.name, right.name, join.name]
+    assert 'already exist' not in caplog.text
+    assert join.upstream_structure == {
+        'nodes': {'input_1', root.name, left.name, right.name, join.name},
+        'edges': {('input_1', root.name), (root.name, left.name), (root.name, right.name),
+                  (left.name, join.name), (right.name, join.name)}
+    }
+
+
+def test_cycle_in_upstream_steps_raises(data, experiment_directory):
+    step_1 = Step(
+        name='test_cycle_in_upstream_steps_raises_1',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step_2 = Step(
+        name='test_cycle_in_upstream_steps_raises_2',
+        transformer=_IDENTITY,
+        input_steps=[step_1],
+        experiment_directory=experiment_directory
+    )
+    with pytest.raises(StepError):
+        step_1.input_steps = [step_2]
+    assert step_1.input_steps == []
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_shared_upstream_step_runs_once(data, n_jobs, experiment_directory):
+    calls = []
+
+    def count_calls(**kwargs):
+        calls.append(kwargs)
+        return kwargs
+
+    root = Step(
+        name='test_shared_upstream_step_runs_once_root',
+        transformer=make_transformer(count_calls),
+        input_data=['input_1'],
+        is_fittable=False,
+        experiment_directory=experiment_directory
+    )
+    left = Step(
+        name='test_shared_upstream_step_runs_once_left',
+        transformer=_IDENTITY,
+        input_steps=[root],
+        adapter=Adapter({'left': E(root.name, 'features')}),
+        experiment_directory=experiment_directory
+    )
+    right = Step(
+        name='test_shared_upstream_step_runs_once_right',
+        transformer=_IDENTITY,
+        input_steps=[root],
+        adapter=Adapter({'right': E(root.name, 'labels')}),
+        experiment_directory=experiment_directory
+    )
+    join = Step(
+        name='test_shared_upstream_step_runs_once_join',
+        transformer=_IDENTITY,
+        input_steps=[left, right],
+        n_jobs=n_jobs,
+        experiment_directory=experiment_directory
+    )
+    output = join.fit_transform(data)
+
+    assert len(calls) == 1
+    assert output['left'] is data['input_1']['features']
+    assert output['right'] is data['input_1']['labels']
+
+
+def test_multiprocessing_backend(data, experiment_directory):
+    left = Step(
+        name='test_multiprocessing_backend_left',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        adapter=Adapter({'left': E('input_1', 'features')}),
+        experiment_directory=experiment_directory
+    )
+    right = Step(
+        name='test_multiprocessing_backend_right',
+        transformer=_IDENTITY,
+        input_data=['input_2'],
+        adapter=Adapter({'right': E('input_2', 'extra_features')}),
+        cache_output=True,
+        experiment_directory=experiment_directory
+    )
+    join = Step(
+        name='test_multiprocessing_backend_join',
+        transformer=_IDENTITY,
+        input_steps=[left, right],
+        n_jobs=2,
+        backend='multiprocessing',
+        experiment_directory=experiment_directory
+    )
+    output = join.fit_transform(data)
+
+    assert np.array_equal(output['left'], data['input_1']['features'])
+    assert np.array_equal(output['right'], data['input_2']['extra_features'])
+    assert right.output_is_cached
+
+
+def test_transformer_fitted_in_worker_process_is_not_loaded_again(data, experiment_directory):
+    class LoadCountingTransformer(BaseTransformer):
+        def __init__(self):
+            super().__init__()
+            self.loads = 0
+
+        def load(self, filepath):
+            self.loads += 1
+            return self
+
+        def transform(self, features):
+            return {'features': features}
+
+    left = Step(
+        name='test_transformer_fitted_in_worker_process_is_not_loaded_again_left',
+        transformer=LoadCountingTransformer(),
+        input_data=['input_1'],
+        adapter=Adapter({'features': E('input_1', 'features')}),
+        experiment_directory=experiment_directory
+    )
+    right = Step(
+        name='test_transformer_fitted_in_worker_process_is_not_loaded_again_right',
+        transformer=_IDENTITY,
+        input_data=['input_2'],
+        experiment_directory=experiment_directory
+    )
+    join = Step(
+        name='test_transformer_fitted_in_worker_process_is_not_loaded_again_join',
+        transformer=_IDENTITY,
+        input_steps=[left, right],
+        n_jobs=2,
+        backend='multiprocessing',
+        experiment_directory=experiment_directory
+    )
+    join.fit_transform(data)
+    left.transform(data)
+
+    assert left.transformer.loads == 0
+
+
+def test_parallel_unsafe_step_runs_in_current_process(data, experiment_directory):
+    def get_pid(features, labels):
+        return {'pid': os.getpid()}
+
+    worker = Step(
+        name='test_parallel_unsafe_step_runs_in_current_process_worker',
+        transformer=make_transformer(get_pid),
+        input_data=['input_1'],
+        adapter=Adapter({'features': E('input_1', 'features'), 'labels': E('input_1', 'labels')}),
+        is_fittable=False,
+        experiment_directory=experiment_directory
+    )
+    local = Step(
+        name='test_parallel_unsafe_step_runs_in_current_process_local',
+        transformer=make_transformer(get_pid),
+        input_data=['input_1'],
+        is_fittable=False,
+        parallel_safe=False,
+        experiment_directory=experiment_directory
+    )
+    join = Step(
+        name='test_parallel_unsafe_step_runs_in_current_process_join',
+        transformer=make_transformer(lambda worker_pid, local_pid: {'pids': (worker_pid, local_pid)}),
+        input_steps=[worker, local],
+        adapter=Adapter({'worker_pid': E(worker.name, 'pid'), 'local_pid': E(local.name, 'pid')}),
+        is_fittable=False,
+        n_jobs=2,
+        backend='multiprocessing',
+        experiment_directory=experiment_directory
+    )
+    worker_pid, local_pid = join.fit_transform(data)['pids']
+
+    assert worker_pid != os.getpid()
+    assert local_pid == os.getpid()
+
+
+def test_steps_are_grouped_into_chains():
+    steps_to_run = [(0, None),
+                    (1, (('step_0', 0),)),
+                    (2, ()),
+                    (3, (('step_1', 1), ('step_2', 2)))]
+    chains, chain_inputs = Step._group_into_chains(steps_to_run)
+
+    assert chains == [steps_to_run[0:2], steps_to_run[2:3], steps_to_run[3:4]]
+    assert chain_inputs == [set(), set(), {0, 1}]
+
+
+def test_step_using_transformer_of_another_step_starts_a_chain():
+    steps_to_run = [(0, ()),
+                    (1, ()),
+                    (2, (('step_1', 1),)),
+                    (3, (('step_0', 0), ('step_2', 2)))]
+    chains, chain_inputs = Step._group_into_chains(steps_to_run, transformer_inputs={2: 0})
+
+    assert chains == [steps_to_run[0:1], steps_to_run[1:2], steps_to_run[2:3], steps_to_run[3:4]]
+    assert chain_inputs == [set(), set(), {0, 1}, {0, 2}]
+
+
+def test_intermediate_outputs_are_dropped_once_collected():
+    steps_to_run = [(0, ()),
+                    (1, (('step_0', 0),)),
+                    (2, (('step_0', 0), ('step_1', 1)))]
+    outputs = _RunOutputs(steps_to_run, 3)
+    outputs[0] = {'a': 0}
+    outputs[1] = {'b': 1}
+
+    assert outputs.collect(steps_to_run[1][1]) == {'step_0': {'a': 0}}
+    assert outputs[0] is not None
+    assert outputs.collect(steps_to_run[2][1]) == {'step_0': {'a': 0}, 'step_1': {'b': 1}}
+    assert outputs[0] is None and outputs[1] is None
+
+
+def test_memoize_transform(data):
+    @memoize_transform
+    class CountingTransformer(BaseTransformer):
+        def __init__(self):
+            super().__init__()
+            self.calls = 0
+
+        def transform(self, features, labels):
+            self.calls += 1
+            return {'features': features, 'labels': labels}
+
+    transformer = CountingTransformer()
+    output_1 = transformer.transform(**data['input_1'])
+    output_2 = transformer.transform(**data['input_1'])
+    assert output_1 is output_2
+    assert transformer.calls == 1
+
+    transformer.transform(features=data['input_2']['extra_features'], labels=data['input_1']['labels'])
+    assert transformer.calls == 2
+
+    transformer.fit_transform(**data['input_1'])
+    assert transformer.calls == 3
+
+
+def test_memoize_transform_forgets_output_of_deleted_input():
+    @memoize_transform
+    class IncrementingTransformer(BaseTransformer):
+        def transform(self, x):
+            return {'x': x + 1}
+
+    transformer = IncrementingTransformer()
+    x = np.arange(3)
+    output = weakref.ref(transformer.transform(x=x)['x'])
+    assert output() is not None
+
+    del x
+    assert output() is None
+
+
+def test_identity_step_transforms_without_fitting(data, experiment_directory):
+    step = Step(
+        name='test_identity_step_transforms_without_fitting',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    output = step.transform(data)
+
+    assert set(output.keys()) == {'features', 'labels'}
+    assert output['features'] is data['input_1']['features']
+    assert not step.transformer_is_persisted
+
+
+def test_subclass_of_identity_operation_is_called(data, experiment_directory):
+    class Doubler(IdentityOperation):
+        def transform(self, features, labels):
+            return {'features': features * 2}
+
+    step = Step(
+        name='test_subclass_of_identity_operation_is_called',
+        transformer=Doubler(),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    output = step.fit_transform(data)
+
+    assert np.array_equal(output['features'], data['input_1']['features'] * 2)
+
+
+def test_persisted_output_is_memory_mapped(data, experiment_directory):
+    step = Step(
+        name='test_persisted_output_is_memory_mapped',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True,
+        load_persisted_output=True,
+        mmap_output=True
+    )
+    step.fit_transform(data)
+    step.force_fitting = False
+    output = step.fit_transform(data)
+
+    assert isinstance(output['features'], np.memmap)
+    assert np.array_equal(output['features'], data['input_1']['features'])
+
+
+def test_persisted_output_is_transformed_without_data(data, experiment_directory):
+    step_1 = Step(
+        name='test_persisted_output_is_transformed_without_data_1',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True,
+        load_persisted_output=True
+    )
+    step_2 = Step(
+        name='test_persisted_output_is_transformed_without_data_2',
+        transformer=_IDENTITY,
+        input_steps=[step_1],
+        experiment_directory=experiment_directory
+    )
+    step_2.fit_transform(data)
+    output = step_2.transform(None)
+
+    _assert_outputs_equal(output, data['input_1'])
+
+
+def test_read_only_output_cannot_be_modified_downstream(data, experiment_directory):
+    def double(features, labels):
+        return {'features': features * 2, 'labels': labels}
+
+    def increment(features, labels):
+        features += 1
+        return {'features': features, 'labels': labels}
+
+    step_a = Step(
+        name='test_read_only_output_a',
+        transformer=make_transformer(double),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        read_only_output=True
+    )
+    step_b = Step(
+        name='test_read_only_output_b',
+        transformer=make_transformer(increment),
+        input_steps=[step_a],
+        experiment_directory=experiment_directory
+    )
+    with pytest.raises(StepError):
+        step_b.fit_transform(data)
+
+    output = step_a.fit_transform(data)
+    assert not output['features'].flags.writeable
+    assert np.array_equal(output['features'], data['input_1']['features'] * 2)
+
+
+def test_read_only_output_leaves_input_arrays_writable(experiment_directory):
+    def double(features, labels):
+        return {'features': features * 2, 'labels': labels}
+
+    features, labels = np.arange(4), np.arange(4)
+    step = Step(
+        name='test_read_only_output_leaves_input_arrays_writable',
+        transformer=make_transformer(double),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        read_only_output=True
+    )
+    output = step.fit_transform({'input_1': {'features': features, 'labels': labels}})
+
+    assert not output['features'].flags.writeable
+    assert output['labels'] is labels
+    assert features.flags.writeable
+    assert labels.flags.writeable
+
+
+def test_persisted_output_is_loaded_lazily(data, experiment_directory):
+    step = Step(
+        name='test_persisted_output_is_loaded_lazily',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True
+    )
+    step.fit_transform(data)
+    output = step._load_output(step.experiment_directory_output_step)
+
+    assert set(output.keys()) == {'features', 'labels'}
+    assert np.array_equal(output['labels'], data['input_1']['labels'])
+    assert np.array_equal(dict(output)['features'], data['input_1']['features'])
+
+
+def test_output_persisted_as_single_file_is_loaded(data, experiment_directory):
+    step = Step(
+        name='test_output_persisted_as_single_file_is_loaded',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    joblib.dump(data['input_1'], step.experiment_directory_output_step)
+
+    assert step.output_is_persisted
+    output = step._load_output(step.experiment_directory_output_step)
+    assert np.array_equal(output['features'], data['input_1']['features'])
+
+
+def test_persisted_transformer_is_found_during_transform(data, experiment_directory):
+    class PassingTransformer(BaseTransformer):
+        def transform(self, features, labels):
+            return {'features': features}
+
+    step = Step(
+        name='test_persisted_transformer_is_found_during_transform',
+        transformer=PassingTransformer(),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    assert not step.transformer_is_persisted
+    step.fit_transform(data)
+    assert step.transformer_is_persisted
+    assert os.path.getsize(step.experiment_directory_transformers_step) == 0
+
+    output = step.transform(data)
+    assert output['features'] is data['input_1']['features']
+
+
+def test_persisted_output_is_overwritten(data, experiment_directory):
+    step = Step(
+        name='test_persisted_output_is_overwritten',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True
+    )
+    step.fit_transform(data)
+    step.input_data = ['input_2']
+    step.fit_transform(data)
+
+    output = step._load_output(step.experiment_directory_output_step)
+    assert list(output.keys()) == ['extra_features']
+    assert len(os.listdir(step.experiment_directory_output_step)) == 2
+
+
+def test_persisted_output_is_written_before_downstream_steps_run(data, experiment_directory):
+    def ones(features, labels):
+        return {'x': np.ones(1000)}
+
+    def zero_in_place(x):
+        x *= 0
+        return {'x': x}
+
+    step_a = Step(
+        name='test_persisted_output_is_written_before_downstream_steps_run_a',
+        transformer=make_transformer(ones),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True
+    )
+    step_b = Step(
+        name='test_persisted_output_is_written_before_downstream_steps_run_b',
+        transformer=make_transformer(zero_in_place),
+        input_steps=[step_a],
+        experiment_directory=experiment_directory
+    )
+    step_b.fit_transform(data)
+
+    assert step_a._load_output(step_a.experiment_directory_output_step)['x'].sum() == 1000
+
+
+def test_persisted_output_is_written_in_background(data, experiment_directory):
+    step = Step(
+        name='test_persisted_output_is_written_in_background',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True,
+        persist_output_in_background=True
+    )
+    step.fit_transform(data)
+
+    output = step._load_output(step.experiment_directory_output_step)
+    assert np.array_equal(output['features'], data['input_1']['features'])
+
+
+def test_transformer_of_step_is_copied(data, experiment_directory):
+    class ValueTransformer(BaseTransformer):
+        def __init__(self, value):
+            super().__init__()
+            self.value = value
+
+        def transform(self, features, labels):
+            return {'value': self.value}
+
+        def persist(self, filepath):
+            joblib.dump(self.value, filepath)
+
+    step_1 = Step(
+        name='test_transformer_of_step_is_copied_1',
+        transformer=ValueTransformer(1),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step_1.fit_transform(data)
+    step_2 = Step(
+        name='test_transformer_of_step_is_copied_2',
+        transformer=step_1,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    assert step_2.transformer is step_1.transformer
+    step_2.transform(data)
+    assert joblib.load(step_2.experiment_directory_transformers_step) == 1
+
+    step_2.transformer = ValueTransformer(2)
+    step_2.fit_transform(data)
+    assert joblib.load(step_2.experiment_directory_transformers_step) == 2
+    assert joblib.load(step_1.experiment_directory_transformers_step) == 1
+
+
+def test_transformer_of_step_is_copied_after_fitting(data, experiment_directory):
+    class MeanTransformer(BaseTransformer):
+        def __init__(self):
+            super().__init__()
+            self.mean = None
+
+        def fit(self, features, labels):
+            self.mean = features.mean()
+            return self
+
+        def transform(self, features, labels):
+            return {'features': features - self.mean}
+
+        def load(self, filepath):
+            self.mean = joblib.load(filepath)
+            return self
+
+        def persist(self, filepath):
+            joblib.dump(self.mean, filepath)
+
+    train_step = Step(
+        name='test_transformer_of_step_is_copied_after_fitting_train',
+        transformer=MeanTransformer(),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    valid_step = Step(
+        name='test_transformer_of_step_is_copied_after_fitting_valid',
+        transformer=train_step,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    valid_data = {'input_1': {'features': data['input_1']['features'] * 2, 'labels': data['input_1']['labels']}}
+    train_step.fit_transform(data)
+    mean = train_step.transformer.mean
+
+    valid_output = valid_step.fit_transform(valid_data)
+
+    assert train_step.transformer.mean == mean
+    assert np.array_equal(valid_output['features'], valid_data['input_1']['features'] - mean)
+    assert joblib.load(valid_step.experiment_directory_transformers_step) == mean
+    _assert_outputs_equal(valid_step.transform(valid_data), valid_output)
+
+
+def test_step_runs_after_step_assigned_as_its_transformer(experiment_directory):
+    class MeanTransformer(BaseTransformer):
+        def __init__(self):
+            super().__init__()
+            self.mean = None
+
+        def fit(self, x):
+            self.mean = float(np.mean(x))
+            return self
+
+        def transform(self, x):
+            return {'x': x - self.mean}
+
+        def load(self, filepath):
+            self.mean = joblib.load(filepath)
+            return self
+
+        def persist(self, filepath):
+            joblib.dump(self.mean, filepath)
+
+    train_step = Step(
+        name='test_step_runs_after_step_assigned_as_its_transformer_train',
+        transformer=MeanTransformer(),
+        input_data=['train'],
+        experiment_directory=experiment_directory
+    )
+    valid_step = Step(
+        name='test_step_runs_after_step_assigned_as_its_transformer_valid',
+        transformer=MeanTransformer(),
+        input_data=['valid'],
+        experiment_directory=experiment_directory
+    )
+    join_step = Step(
+        name='test_step_runs_after_step_assigned_as_its_transformer_join',
+        transformer=_IDENTITY,
+        input_steps=[valid_step, train_step],
+        adapter=Adapter({'x': E(valid_step.name, 'x')}),
+        experiment_directory=experiment_directory
+    )
+    join_step.fit_transform({'train': {'x': np.ones(3)}, 'valid': {'x': np.full(3, 5.0)}})
+
+    valid_step.transformer = train_step
+    output = join_step.fit_transform({'train': {'x': np.full(3, 2.0)}, 'valid': {'x': np.full(3, 5.0)}})
+
+    assert np.array_equal(output['x'], np.full(3, 3.0))
+
+
+def test_file_is_copied(tmpdir):
+    src = tmpdir.join('src')
+    src.write_binary(os.urandom(100000))
+    dst = tmpdir.join('dst')
+    _copy_file(str(src), str(dst))
+    assert dst.read_binary() == src.read_binary()
+
+
+def test_persisted_output_of_changed_transformer_is_not_loaded(data, experiment_directory):
+    class ScalingTransformer(BaseTransformer):
+        def __init__(self, scale):
+            super().__init__()
+            self.scale = scale
+
+        def get_params(self):
+            return {'scale': self.scale}
+
+        def transform(self, features, labels):
+            return {'features': features * self.scale}
+
+    step = Step(
+        name='test_persisted_output_of_changed_transformer_is_not_loaded',
+        transformer=ScalingTransformer(2),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True,
+        load_persisted_output=True,
+        force_fitting=False
+    )
+    step.fit_transform(data)
+    assert np.array_equal(step.transform(data)['features'], 2 * data['input_1']['features'])
+
+    step.transformer = ScalingTransformer(3)
+    assert np.array_equal(step.transform(data)['features'], 3 * data['input_1']['features'])
+
+
+def test_shared_transformer_is_loaded_from_file_of_each_step(experiment_directory):
+    class MeanTransformer(BaseTransformer):
+        def __init__(self):
+            super().__init__()
+            self.mean = None
+
+        def fit(self, x):
+            self.mean = float(np.mean(x))
+            return self
+
+        def transform(self, x):
+            return {'mean': self.mean}
+
+        def persist(self, filepath):
+            joblib.dump(self.mean, filepath)
+
+        def load(self, filepath):
+            self.mean = joblib.load(filepath)
+            return self
+
+    transformer = MeanTransformer()
+    step_1 = Step(
+        name='test_shared_transformer_is_loaded_from_file_of_each_step_1',
+        transformer=transformer,
+        input_data=['input'],
+        experiment_directory=experiment_directory
+    )
+    step_1.fit_transform({'input': {'x': np.ones(3)}})
+    step_2 = Step(
+        name='test_shared_transformer_is_loaded_from_file_of_each_step_2',
+        transformer=transformer,
+        input_data=['input'],
+        experiment_directory=experiment_directory
+    )
+    step_2.fit_transform({'input': {'x': np.full(3, 9)}})
+
+    assert step_1.transform({'input': {'x': np.ones(3)}}) == {'mean': 1.0}
+    assert step_2.transform({'input': {'x': np.ones(3)}}) == {'mean': 9.0}
+
+
+def test_transformer_is_loaded_once(data, experiment_directory):
+    class LoadCountingTransformer(BaseTransformer):
+        def __init__(self):
+            super().__init__()
+            self.loads = 0
+
+        def load(self, filepath):
+            self.loads += 1
+            return self
+
+        def transform(self, features, labels):
+            return {'features': features}
+
+    step = Step(
+        name='test_transformer_is_loaded_once',
+        transformer=LoadCountingTransformer(),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory
+    )
+    step.fit_transform(data)
+    step.transform(data)
+    step.transform(data)
+    assert step.transformer.loads == 0
+
+    os.utime(step.experiment_directory_transformers_step, ns=(0, 0))
+    step.transform(data)
+    step.transform(data)
+    assert step.transformer.loads == 1
+
+
+def test_persisted_output_of_other_data_is_not_loaded(data, experiment_directory):
+    step = Step(
+        name='test_persisted_output_of_other_data_is_not_loaded',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True,
+        load_persisted_output=True
+    )
+    step.fit_transform(data)
+    new_data = {'input_1': {'features': data['input_1']['features'] + 1, 'labels': data['input_1']['labels']}}
+    output = step.transform(new_data)
+
+    assert np.array_equal(output['features'], new_data['input_1']['features'])
+
+
+def test_step_shared_by_nested_run_keeps_fingerprint(data, experiment_directory):
+    calls = []
+
+    def run_nested(features, labels):
+        if not calls:
+            calls.append('nested')
+            step_b.fit_transform(data)
+        return {'features': features}
+
+    def count_calls(features):
+        calls.append('step_b')
+        return {'features': features}
+
+    step_a = Step(
+        name='test_step_shared_by_nested_run_keeps_fingerprint_a',
+        transformer=make_transformer(run_nested),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        is_fittable=False
+    )
+    step_b = Step(
+        name='test_step_shared_by_nested_run_keeps_fingerprint_b',
+        transformer=make_transformer(count_calls),
+        input_steps=[step_a],
+        experiment_directory=experiment_directory,
+        is_fittable=False,
+        persist_output=True,
+        load_persisted_output=True
+    )
+    step_b.fit_transform(data)
+    step_b.transform(data)
+
+    assert calls == ['nested', 'step_b', 'step_b']
+
+
+def test_persisted_output_is_loaded_without_its_input_data(data, experiment_directory):
+    step_a = Step(
+        name='test_persisted_output_is_loaded_without_its_input_data_a',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True,
+        load_persisted_output=True
+    )
+    step_b = Step(
+        name='test_persisted_output_is_loaded_without_its_input_data_b',
+        transformer=_IDENTITY,
+        input_steps=[step_a],
+        experiment_directory=experiment_directory
+    )
+    step_b.fit_transform(data)
+    output = step_b.transform({})
+
+    assert np.array_equal(output['features'], data['input_1']['features'])
+
+
+def test_unchecked_persisted_output_is_logged(caplog, data, experiment_directory):
+    step = Step(
+        name='test_unchecked_persisted_output_is_logged',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True,
+        load_persisted_output=True
+    )
+    step.fit_transform(data)
+    assert 'could not check' not in caplog.text
+
+    step.transform({})
+    assert 'could not check' in caplog.text
+
+
+def test_unpicklable_input_data_is_not_fingerprinted(data, experiment_directory):
+    lock = threading.Lock()
+    step_a = Step(
+        name='test_unpicklable_input_data_is_not_fingerprinted_a',
+        transformer=_IDENTITY,
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        persist_output=True
+    )
+    step_b = Step(
+        name='test_unpicklable_input_data_is_not_fingerprinted_b',
+        transformer=_IDENTITY,
+        input_data=['resources'],
+        input_steps=[step_a],
+        experiment_directory=experiment_directory
+    )
+    output = step_b.fit_transform({'input_1': data['input_1'], 'resources': {'lock': lock}})
+
+    assert output['lock'] is lock
+    assert step_a.output_is_persisted
+
+
+def test_persisted_output_with_arrays_and_objects(data, experiment_directory):
+    step = Step(
+        name='test_persisted_output_with_arrays_and_objects',
+        transformer=make_transformer(lambda features, labels: {'features': features, 'labels': list(labels)}),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        is_fittable=False,
+        persist_output=True
+    )
+    step.fit_transform(data)
+    output = step._load_output(step.experiment_directory_output_step)
+
+    assert sorted(os.listdir(step.experiment_directory_output_step)) == ['0.npy', '1.pkl', '_index.pkl']
+    assert np.array_equal(output['features'], data['input_1']['features'])
+    assert output['labels'] == list(data['input_1']['labels'])
+
+
+def test_persisted_output_with_non_str_keys(data, experiment_directory):
+    step = Step(
+        name='test_persisted_output_with_non_str_keys',
+        transformer=make_transformer(lambda features, labels: {('features', 1): features, 2: labels}),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        is_fittable=False,
+        persist_output=True,
+        load_persisted_output=True
+    )
+    step.fit_transform(data)
+    output = step.transform(data)
+
+    assert isinstance(output, dict)
+    assert set(output.keys()) == {('features', 1), 2}
+    assert np.array_equal(output[2], data['input_1']['labels'])
+
+
+def test_persisted_output_with_compressed_objects(data, experiment_directory):
+    step = Step(
+        name='test_persisted_output_with_compressed_objects',
+        transformer=make_transformer(lambda features, labels: {'features': features, 'labels': list(labels)}),
+        input_data=['input_1'],
+        experiment_directory=experiment_directory,
+        is_fittable=False,
+        persist_output=True,
+        mmap_output=True,
+        compress_output=3
+    )
+    step.fit_transform(data)
+    output = step._load_output(step.experiment_directory_output_step)
+
+    assert sorted(os.listdir(step.experiment_directory_output_step)) == ['0.npy', '1.pkl.z', '_index.pkl']
+    assert isinstance(output['features'], np.memmap)
+    assert output['labels'] == list(data['input_1']['labels'])
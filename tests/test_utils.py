@@ -0,0 +1,32 @@
+import joblib
+import numpy as np
+
+from steppy.utils import cheap_hash, _create_graph
+
+
+def test_cheap_hash_of_small_objects_is_joblib_hash():
+    value = {'features': np.arange(10), 'name': 'train'}
+    assert cheap_hash(value) == joblib.hash(value)
+
+
+def test_cheap_hash_of_large_array_depends_on_sample():
+    array = np.zeros(10000)
+    assert cheap_hash(array) == cheap_hash(array.copy())
+    assert cheap_hash(array) != cheap_hash(array.reshape(100, 100))
+    assert cheap_hash(array) != cheap_hash(array.astype(np.float32))
+
+    changed_in_sample = array.copy()
+    changed_in_sample[0] = 1
+    assert cheap_hash(array) != cheap_hash(changed_in_sample)
+
+    changed_outside_sample = array.copy()
+    changed_outside_sample[1] = 1
+    assert cheap_hash(array) == cheap_hash(changed_outside_sample)
+    assert cheap_hash(array, strict=True) != cheap_hash(changed_outside_sample, strict=True)
+
+
+def test_graph_is_created_from_nodes_of_mixed_types():
+    graph = _create_graph({'nodes': {'step', 0}, 'edges': {(0, 'step'), ('step', 'step')}})
+
+    assert [node.get_name() for node in graph.get_nodes()] == ['0', 'step']
+    assert len(graph.get_edges()) == 2